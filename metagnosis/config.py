@@ -1,7 +1,7 @@
 from pydantic import BaseModel
 from os import getcwd, makedirs
 from os.path import join
-from typing import Optional
+from typing import Literal, Optional
 
 data_path = join(getcwd(), "data")
 
@@ -28,6 +28,53 @@ class Config(BaseModel):
         "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/128.0.0.0 Safari/537.36"
     )
     fetch_retries: int = 4
+    fetch_backoff: float = 1.0
+    fetch_backoff_max: float = 60.0
+    host_rate: float = 5.0
+    host_burst: int = 10
+    max_pdf_size: int = 104857600
+    extract_workers: Optional[int] = None
+    extract_pages_per_task: int = 16
+    encode_batch_size: int = 8
+    encode_max_length: int = 512
+    encode_max_latency: float = 0.05
+    encode_backend: Literal["torch", "onnx"] = "torch"
+    encode_quantization: Optional[Literal["arm64", "avx2", "avx512", "avx512_vnni"]] = (
+        "avx512_vnni"
+    )
+    embedding_cache_size: int = 100000
+    llm_batch_size: int = 4
+    llm_max_input_tokens: int = 2048
+    llm_max_new_tokens: int = 150
+    metadata_batch: int = 32
+    vector_dimension: int = 1024
+    vector_precision: Literal["float32", "int8", "bit"] = "float32"
+    vector_rescore: bool = True
+    vector_oversample: int = 8
+    write_window: float = 0.5
+    write_batch: int = 500
+    http_limit: int = 100
+    http_limit_per_host: int = 10
+    http_dns_ttl: int = 300
+    http_keepalive: float = 30
+    http_connect_timeout: float = 30
+    http_read_timeout: float = 60
+    http_total_timeout: float = 300
+    duplicate_threshold: float = 0.95
+    duplicate_window: int = 604800
+    duplicate_candidates: int = 8
+    pdf_lease: int = 600
+    pipeline_queue_size: int = 2
+    pipeline_extract_workers: int = 2
+    pipeline_encode_workers: int = 2
+    job_concurrency: int = 4
+    job_timeout: float = 3600
+    metrics_host: str = "127.0.0.1"
+    metrics_port: Optional[int] = 9464
+    metrics_retention: int = 604800
+    # Each document worker serves on the first free port from this one
+    metrics_worker_port: Optional[int] = 9465
+    metrics_worker_ports: int = 16
     proxy: Optional[str] = None
     lulu_auth: str
     aws_access_key_id: str
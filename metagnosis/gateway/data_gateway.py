@@ -2,34 +2,68 @@ from abc import ABC, abstractmethod
 from asyncio import Lock
 from contextlib import asynccontextmanager
 from os import makedirs
-from aiosqlite import Connection
+from aiosqlite import Connection, connect
+from sqlite_vec import loadable_path
+from .write_queue import WriteQueue
 from ..config import get_config, Config
 
 
+async def open_database(path: str) -> Connection:
+    db = await connect(path)
+
+    await db.enable_load_extension(True)
+    await db.load_extension(loadable_path())
+    await db.enable_load_extension(False)
+    await db.execute("PRAGMA journal_mode=WAL;")
+
+    return db
+
+
 class StorageGateway(ABC):
     db: Connection
     storage_path: str
     process_lock: Lock
+    writer: WriteQueue
     config: Config
 
-    def __init__(self, db: Connection, storage_path: str, process_lock: Lock):
+    def __init__(
+        self, db: Connection, storage_path: str, process_lock: Lock, writer: WriteQueue
+    ):
         self.config = get_config()
         self.process_lock = process_lock
+        self.writer = writer
         self.db = db
         self.storage_path = storage_path
 
     @classmethod
-    async def new(cls, db: Connection, storage_path: str, process_lock: Lock):
+    async def new(
+        cls,
+        db: Connection,
+        storage_path: str,
+        process_lock: Lock,
+        writer: WriteQueue,
+        *args,
+    ):
         makedirs(storage_path, exist_ok=True)
+        gateway = cls(db, storage_path, process_lock, writer, *args)
 
-        for q in cls.SCHEMA.split(";"):
+        for q in gateway.SCHEMA.split(";"):
             if not q:
                 continue
 
             await db.execute(q)
-            await db.commit()
 
-        return cls(db, storage_path, process_lock)
+        await db.commit()
+        await gateway.migrate()
+
+        return gateway
+
+    async def migrate(self):
+        pass
+
+    async def columns(self, table: str) -> set[str]:
+        async with self.db.execute(f"PRAGMA table_info({table})") as cursor:
+            return {row[1] async for row in cursor}
 
     @property
     @abstractmethod
@@ -42,6 +76,8 @@ class StorageGateway(ABC):
             try:
                 yield
                 await self.db.commit()
-            except Exception as e:
+            except BaseException as e:
+                # Includes cancellation, a half written transaction must not be
+                # left open on the shared connection for the next commit
                 await self.db.rollback()
                 raise e
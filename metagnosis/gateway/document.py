@@ -1,35 +1,153 @@
 import numpy as np
 
 from datetime import datetime
-from json import dumps, loads
+from json import loads
 from os import remove
-from typing import List
+from typing import List, Optional, Union
 from .data_gateway import StorageGateway
 from ..log import log
 from ..models.document import Document
 
+VECTOR_TYPES = {"float32": "float", "int8": "int8", "bit": "bit"}
+VECTOR_PARAMS = {"float32": "?", "int8": "vec_int8(?)", "bit": "vec_bit(?)"}
+
+
+def pack_vector(vector, precision: str = "float32") -> bytes:
+    vector = np.asarray(vector, dtype=np.float32)
+
+    if precision == "int8":
+        norm = np.linalg.norm(vector) or 1
+        return np.round(vector / norm * 127).astype(np.int8).tobytes()
+    elif precision == "bit":
+        return np.packbits(vector > 0).tobytes()
+
+    return vector.tobytes()
+
+
+def unpack_vector(blob: bytes, precision: str = "float32") -> np.ndarray:
+    if precision == "int8":
+        return np.frombuffer(blob, dtype=np.int8)
+    elif precision == "bit":
+        bits = np.unpackbits(np.frombuffer(blob, dtype=np.uint8))
+        return bits.astype(np.int8) * 2 - 1
+
+    return np.frombuffer(blob, dtype=np.float32)
+
 
 class DocumentGateway(StorageGateway):
-    SCHEMA = """
+    MIGRATION_BATCH = 1000
+    dimension: int
+    precision: str
+    rescore: bool
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.dimension = self.config.vector_dimension
+        self.precision = self.config.vector_precision
+        self.rescore = self.config.vector_rescore and self.precision != "float32"
+
+    @property
+    def vector_column(self) -> str:
+        column = f"vector {VECTOR_TYPES[self.precision]}[{self.dimension}]"
+
+        # Bit vectors only support hamming distance
+        if self.precision != "bit":
+            column += " distance_metric=cosine"
+
+        return column
+
+    @property
+    def SCHEMA(self):
+        return f"""
         CREATE TABLE IF NOT EXISTS document (
             id TEXT PRIMARY KEY,
             path TEXT NOT NULL,
             origin TEXT NOT NULL,
             score INT NOT NULL,
-            vector FLOAT[1024] NOT NULL,
             processed BOOLEAN NOT NULL,
             created DATETIME NOT NULL,
             updated DATETIME NOT NULL
         );
-    """
+
+        CREATE INDEX IF NOT EXISTS idx_document_origin_created
+        ON document (origin, created);
+
+        CREATE VIRTUAL TABLE IF NOT EXISTS document_vector USING vec0(
+            id TEXT PRIMARY KEY,
+            {self.vector_column}
+        );
+
+        CREATE TABLE IF NOT EXISTS document_vector_full (
+            id TEXT PRIMARY KEY,
+            vector BLOB NOT NULL
+        );
+        """
+
+    async def migrate(self):
+        query = "SELECT sql FROM sqlite_master WHERE name = 'document_vector'"
+
+        async with self.db.execute(query) as cursor:
+            row = await cursor.fetchone()
+
+        if self.vector_column not in row[0]:
+            log.info(
+                f"document_vector was not created with {self.vector_column}, "
+                "drop it and re-encode documents to apply the vector settings"
+            )
+
+        if "vector" not in await self.columns("document"):
+            return
+
+        log.info("Migrating document vectors to document_vector")
+
+        async with self.db.execute("SELECT id, vector FROM document") as cursor:
+            while rows := await cursor.fetchmany(self.MIGRATION_BATCH):
+                vectors = {row[0]: loads(row[1])[: self.dimension] for row in rows}
+
+                for query, args, many in self.vector_writes(vectors):
+                    await self.db.executemany(query, args)
+
+        await self.db.execute("ALTER TABLE document DROP COLUMN vector")
+        await self.db.commit()
+
+    def vector_writes(self, vectors: dict[str, List[float]]) -> list:
+        writes = [
+            (
+                "INSERT INTO document_vector (id, vector) "
+                f"VALUES (?, {VECTOR_PARAMS[self.precision]})",
+                [(id, pack_vector(v, self.precision)) for id, v in vectors.items()],
+                True,
+            )
+        ]
+
+        if self.rescore:
+            writes.append(
+                (
+                    "INSERT OR REPLACE INTO document_vector_full (id, vector) "
+                    "VALUES (?, ?)",
+                    [(id, pack_vector(v)) for id, v in vectors.items()],
+                    True,
+                )
+            )
+
+        return writes
+
+    def distance(self, column: str) -> str:
+        if self.precision == "bit":
+            return f"vec_distance_hamming({column}, vec_bit(?)) / {self.dimension}.0"
+
+        return f"vec_distance_cosine({column}, {VECTOR_PARAMS[self.precision]})"
 
     async def save_documents(self, documents: List[Document], commit=True):
         log.info(f"Saving {len(documents)} documents")
 
+        if not documents:
+            return
+
         stmt = """
             INSERT OR REPLACE INTO document
-            (id, path, origin, score, vector, processed, created, updated)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            (id, path, origin, score, processed, created, updated)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
         """
         params = [
             (
@@ -37,32 +155,44 @@ class DocumentGateway(StorageGateway):
                 d.path,
                 d.origin,
                 d.score,
-                dumps(
-                    d.vector.tolist() if isinstance(d.vector, np.ndarray) else d.vector
-                ),
                 d.processed,
                 d.created,
                 d.updated,
             )
             for d in documents
         ]
-
-        await self.db.executemany(stmt, params)
+        ids = [d.id for d in documents]
+        placeholders = ",".join(["?" for _ in ids])
+        writes = [
+            # vec0 tables do not support INSERT OR REPLACE
+            (f"DELETE FROM document_vector WHERE id IN ({placeholders})", ids, False),
+            (stmt, params, True),
+        ] + self.vector_writes({d.id: d.vector for d in documents})
 
         if commit:
-            await self.db.commit()
+            await self.writer.write_all(writes)
+        else:
+            for query, args, many in writes:
+                if many:
+                    await self.db.executemany(query, args)
+                else:
+                    await self.db.execute(query, args)
 
     async def _get_docs(
         self, origin: str, after: datetime, rank_threshold: int, limit: int
     ) -> list[Document]:
-        query = """
+        precision = "float32" if self.rescore else self.precision
+        table = "document_vector_full" if self.rescore else "document_vector"
+        query = f"""
         SELECT
-            id, path, origin, score, vector, processed, created, updated
-        FROM document
-        WHERE processed = FALSE
-        AND score >= ?
-        AND origin = ?
-        ORDER BY score DESC
+            d.id, d.path, d.origin, d.score, v.vector, d.processed, d.created,
+            d.updated
+        FROM document d
+        JOIN {table} v ON v.id = d.id
+        WHERE d.processed = FALSE
+        AND d.score >= ?
+        AND d.origin = ?
+        ORDER BY d.score DESC
         """
 
         if limit:
@@ -73,21 +203,134 @@ class DocumentGateway(StorageGateway):
         async with self.db.execute(query, (rank_threshold, origin)) as cursor:
             async for row in cursor:
                 results.append(
-                    Document(
+                    Document.model_construct(
                         id=row[0],
                         path=row[1],
                         origin=row[2],
                         data_type="pdf",
                         score=row[3],
-                        vector=np.array(loads(row[4])),
+                        vector=unpack_vector(row[4], precision),
                         processed=bool(row[5]),
-                        created=row[6],
-                        updated=row[7],
+                        created=datetime.fromisoformat(row[6]),
+                        updated=datetime.fromisoformat(row[7]),
                     )
                 )
 
         return results
 
+    async def get_vector(self, id: str) -> Optional[np.ndarray]:
+        precision = "float32" if self.rescore else self.precision
+        table = "document_vector_full" if self.rescore else "document_vector"
+        query = f"SELECT vector FROM {table} WHERE id = ?"
+
+        async with self.db.execute(query, (id,)) as cursor:
+            row = await cursor.fetchone()
+
+        return unpack_vector(row[0], precision) if row else None
+
+    async def get_created(self, ids: list[str]) -> dict[str, datetime]:
+        if not ids:
+            return {}
+
+        placeholders = ",".join(["?" for _ in ids])
+        query = f"SELECT id, created FROM document WHERE id IN ({placeholders})"
+
+        async with self.db.execute(query, ids) as cursor:
+            return {row[0]: datetime.fromisoformat(row[1]) async for row in cursor}
+
+    async def find_similar(
+        self,
+        doc_id_or_vector: Union[str, List[float], np.ndarray],
+        k: int,
+        origin: Optional[str] = None,
+        since: Optional[datetime] = None,
+    ) -> list[tuple[str, float]]:
+        exclude = None
+
+        if isinstance(doc_id_or_vector, str):
+            exclude = doc_id_or_vector
+            vector = await self.get_vector(exclude)
+
+            if vector is None:
+                raise KeyError(f"No vector for document {exclude}")
+        else:
+            vector = doc_id_or_vector
+
+        limit = k + 1 if exclude else k
+        filters = []
+        filter_params = []
+
+        if origin is not None:
+            filters.append("d.origin = ?")
+            filter_params.append(origin)
+
+        if since is not None:
+            filters.append("d.created >= ?")
+            filter_params.append(since)
+
+        if not filters:
+            query = f"""
+            SELECT id, distance
+            FROM document_vector
+            WHERE vector MATCH {VECTOR_PARAMS[self.precision]}
+            AND k = ?
+            ORDER BY distance
+            """
+            candidates = (
+                limit * self.config.vector_oversample if self.rescore else limit
+            )
+            params = [pack_vector(vector, self.precision), candidates]
+        elif self.rescore:
+            query = f"""
+            SELECT d.id, vec_distance_cosine(v.vector, ?) AS distance
+            FROM document d
+            JOIN document_vector_full v ON v.id = d.id
+            WHERE {" AND ".join(filters)}
+            ORDER BY distance
+            LIMIT ?
+            """
+            params = [pack_vector(vector)] + filter_params + [limit]
+        else:
+            # vec0 KNN cannot filter on columns of another table, so
+            # filtered lookups scan the matching rows with the same metric
+            query = f"""
+            SELECT d.id, {self.distance("v.vector")} AS distance
+            FROM document d
+            JOIN document_vector v ON v.id = d.id
+            WHERE {" AND ".join(filters)}
+            ORDER BY distance
+            LIMIT ?
+            """
+            params = [pack_vector(vector, self.precision)] + filter_params + [limit]
+
+        async with self.db.execute(query, params) as cursor:
+            results = [(row[0], row[1]) async for row in cursor if row[0] != exclude]
+
+        if not filters and self.rescore:
+            results = await self.rescore_results(vector, [r[0] for r in results], k)
+        elif not filters and self.precision == "bit":
+            results = [(id, distance / self.dimension) for id, distance in results]
+
+        return results[:k]
+
+    async def rescore_results(
+        self, vector: Union[List[float], np.ndarray], ids: list[str], k: int
+    ) -> list[tuple[str, float]]:
+        if not ids:
+            return []
+
+        placeholders = ",".join(["?" for _ in ids])
+        query = f"""
+        SELECT id, vec_distance_cosine(vector, ?) AS distance
+        FROM document_vector_full
+        WHERE id IN ({placeholders})
+        ORDER BY distance
+        LIMIT ?
+        """
+
+        async with self.db.execute(query, [pack_vector(vector)] + ids + [k]) as cursor:
+            return [(row[0], row[1]) async for row in cursor]
+
     async def delete_doc(self, id):
         await self._delete_docs([id])
 
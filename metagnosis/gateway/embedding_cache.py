@@ -0,0 +1,70 @@
+import numpy as np
+
+from time import time
+from .data_gateway import StorageGateway
+from .document import pack_vector, unpack_vector
+
+
+class EmbeddingCacheGateway(StorageGateway):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS embedding_cache (
+            model TEXT NOT NULL,
+            hash TEXT NOT NULL,
+            vector BLOB NOT NULL,
+            accessed INT NOT NULL,
+            PRIMARY KEY (model, hash)
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_embedding_cache_accessed
+        ON embedding_cache (accessed);
+    """
+
+    async def get_vectors(self, model: str, hashes: list[str]) -> dict[str, np.ndarray]:
+        if not hashes:
+            return {}
+
+        placeholders = ",".join(["?" for _ in hashes])
+        query = f"""
+            SELECT hash, vector
+            FROM embedding_cache
+            WHERE model = ?
+            AND hash IN ({placeholders})
+        """
+
+        async with self.db.execute(query, [model] + hashes) as cursor:
+            vectors = {row[0]: unpack_vector(row[1]) async for row in cursor}
+
+        if vectors:
+            touch = f"""
+                UPDATE embedding_cache
+                SET accessed = ?
+                WHERE model = ?
+                AND hash IN ({",".join(["?" for _ in vectors])})
+            """
+            self.writer.submit(touch, [int(time()), model] + list(vectors))
+
+        return vectors
+
+    async def save_vectors(self, model: str, vectors: dict[str, np.ndarray]):
+        if not vectors:
+            return
+
+        query = """
+            INSERT OR REPLACE INTO embedding_cache
+            (model, hash, vector, accessed)
+            VALUES
+            (?, ?, ?, ?)
+        """
+        evict = """
+            DELETE FROM embedding_cache
+            WHERE rowid IN (
+                SELECT rowid FROM embedding_cache
+                ORDER BY accessed DESC
+                LIMIT -1 OFFSET ?
+            )
+        """
+        now = int(time())
+        rows = [(model, h, pack_vector(v), now) for h, v in vectors.items()]
+
+        self.writer.submit(query, rows, many=True)
+        self.writer.submit(evict, (self.config.embedding_cache_size,))
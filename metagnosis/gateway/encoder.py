@@ -1,15 +1,127 @@
-from asyncio import get_running_loop
+import numpy as np
+
+from asyncio import (
+    Future,
+    Queue,
+    Task,
+    TimeoutError,
+    gather,
+    get_running_loop,
+    shield,
+    wait_for,
+)
 from concurrent.futures import ThreadPoolExecutor
-from typing import List, Tuple
-from sentence_transformers import SentenceTransformer
+from hashlib import sha256
+from time import perf_counter
+from os.path import exists, join
+from threading import Lock
+from typing import List, Optional, Tuple, TYPE_CHECKING
+from .embedding_cache import EmbeddingCacheGateway
+from ..config import get_config, Config
 from ..log import log
+from ..util.metrics import encode_batch_seconds, encode_batch_size, encode_cache
+from ..util.timing import timed
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
 
 
 class EncoderGateway:
-    def __init__(self):
+    # Upper bound on characters per token, used to cut text before tokenizing
+    CHARS_PER_TOKEN = 8
+    config: Config
+    cache: EmbeddingCacheGateway
+    max_length: int
+    batch_size: int
+    max_latency: float
+    dimension: int
+    backend: str
+    quantization: Optional[str]
+    queue: Queue
+    pending: dict[str, Future]
+    worker: Optional[Task]
+    _model: Optional["SentenceTransformer"]
+
+    def __init__(
+        self, cache: Optional[EmbeddingCacheGateway], backend: Optional[str] = None
+    ):
+        self.config = get_config()
+        self.cache = cache
         self.model_name = "dunzhang/stella_en_1.5B_v5"
-        self.model = SentenceTransformer(self.model_name)
-        self.pool = ThreadPoolExecutor(max_workers=4)
+        self.backend = backend or self.config.encode_backend
+        self.quantization = self.config.encode_quantization
+        self.max_length = self.config.encode_max_length
+        self.batch_size = self.config.encode_batch_size
+        self.max_latency = self.config.encode_max_latency
+        self.dimension = self.config.vector_dimension
+        self._model = None
+        self.model_lock = Lock()
+        # One forward pass at a time so batches don't fight over torch threads.
+        # Truncation runs here too, the fast tokenizer can't be used from two
+        # threads at once
+        self.model_pool = ThreadPoolExecutor(max_workers=1)
+        self.queue = Queue()
+        self.pending = {}
+        self.worker = None
+
+    @property
+    def model(self) -> "SentenceTransformer":
+        # Loaded on first use from whichever executor thread gets there first
+        with self.model_lock:
+            if self._model is None:
+                with timed(f"Loading {self.model_name} ({self.cache_key})"):
+                    if self.backend == "onnx":
+                        self._model = self.load_onnx()
+                    else:
+                        from sentence_transformers import SentenceTransformer
+
+                        self._model = SentenceTransformer(self.model_name)
+
+                    self._model.max_seq_length = self.max_length
+
+        return self._model
+
+    @property
+    def cache_key(self) -> str:
+        # Backends agree closely but not exactly, keep their vectors apart
+        if self.backend == "onnx":
+            return f"{self.model_name}:onnx:{self.quantization or 'fp32'}"
+
+        return self.model_name
+
+    @property
+    def onnx_path(self) -> str:
+        return join(
+            self.config.storage_path, "onnx", self.model_name.replace("/", "--")
+        )
+
+    def load_onnx(self) -> "SentenceTransformer":
+        from sentence_transformers import (
+            SentenceTransformer,
+            export_dynamic_quantized_onnx_model,
+        )
+
+        path = self.onnx_path
+        file_name = "onnx/model.onnx"
+
+        if not exists(join(path, file_name)):
+            log.info(f"Exporting {self.model_name} to ONNX at {path}")
+
+            model = SentenceTransformer(self.model_name, backend="onnx")
+            model.save_pretrained(path)
+
+        if self.quantization:
+            file_name = f"onnx/model_qint8_{self.quantization}.onnx"
+
+            if not exists(join(path, file_name)):
+                log.info(f"Quantizing {self.model_name} for {self.quantization}")
+
+                model = SentenceTransformer(path, backend="onnx")
+                export_dynamic_quantized_onnx_model(model, self.quantization, path)
+
+        return SentenceTransformer(
+            path, backend="onnx", model_kwargs={"file_name": file_name}
+        )
 
     async def encode(
         self, values: List[Tuple[str, str]]
@@ -23,6 +135,136 @@ class EncoderGateway:
         ids = [i[0] for i in values]
         strings = [i[1] for i in values]
 
-        result = await loop.run_in_executor(self.pool, self.model.encode, strings)
+        texts, lengths = await loop.run_in_executor(
+            self.model_pool, self.truncate, strings
+        )
+        hashes = [sha256(t.encode("utf-8")).hexdigest() for t in texts]
+        vectors = await self.cache.get_vectors(self.cache_key, list(set(hashes)))
+        missing = {h: i for i, h in enumerate(hashes) if h not in vectors}
+
+        log.info(f"Found {len(values) - len(missing)} cached embeddings")
+        encode_cache.inc(len(values) - len(missing), result="hit")
+        encode_cache.inc(len(missing), result="miss")
+
+        if missing:
+            result = await gather(
+                *(
+                    shield(self.submit(h, texts[i], lengths[i]))
+                    for h, i in missing.items()
+                )
+            )
+            encoded = dict(zip(missing, result))
+
+            await self.cache.save_vectors(self.cache_key, encoded)
+            vectors.update(encoded)
+
+        # Matryoshka truncation, the cache keeps full vectors
+        return [
+            (id, vectors[h][: self.dimension].tolist()) for id, h in zip(ids, hashes)
+        ]
+
+    def submit(self, hash: str, text: str, length: int) -> Future:
+        if hash in self.pending:
+            return self.pending[hash]
+
+        loop = get_running_loop()
+        future = loop.create_future()
+        self.pending[hash] = future
+        self.queue.put_nowait((hash, text, length, future))
+
+        if self.worker is None or self.worker.done():
+            self.worker = loop.create_task(self.run())
+
+        return future
+
+    async def run(self):
+        loop = get_running_loop()
+
+        while 1:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_latency
+
+            while len(batch) < self.batch_size:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+
+                timeout = deadline - loop.time()
+
+                if timeout <= 0:
+                    break
+
+                try:
+                    batch.append(await wait_for(self.queue.get(), timeout))
+                except TimeoutError:
+                    break
+
+            log.info(f"Encoding micro-batch of {len(batch)}")
+            encode_batch_size.observe(len(batch))
+            start = perf_counter()
+
+            try:
+                result = await loop.run_in_executor(
+                    self.model_pool,
+                    self.encode_batches,
+                    [i[1] for i in batch],
+                    [i[2] for i in batch],
+                )
+            except Exception as e:
+                log.exception(e)
+                result = [e] * len(batch)
+
+            encode_batch_seconds.observe(perf_counter() - start)
+
+            for (hash, _, _, future), vector in zip(batch, result):
+                del self.pending[hash]
+
+                if future.done():
+                    continue
+                elif isinstance(vector, Exception):
+                    future.set_exception(vector)
+                else:
+                    future.set_result(vector)
+
+    async def close(self):
+        if self.worker is not None:
+            self.worker.cancel()
+
+        self.model_pool.shutdown(wait=False, cancel_futures=True)
+
+    def truncate(self, texts: List[str]) -> Tuple[List[str], List[int]]:
+        texts = [t[: self.max_length * self.CHARS_PER_TOKEN] for t in texts]
+        tokenizer = self.model.tokenizer
+
+        if not getattr(tokenizer, "is_fast", False):
+            return texts, [len(t) for t in texts]
+
+        offsets = tokenizer(
+            texts,
+            add_special_tokens=False,
+            truncation=True,
+            max_length=self.max_length,
+            return_offsets_mapping=True,
+        )["offset_mapping"]
+
+        return (
+            [t[: o[-1][1]] if o else t for t, o in zip(texts, offsets)],
+            [len(o) for o in offsets],
+        )
+
+    def encode_batches(self, texts: List[str], lengths: List[int]) -> np.ndarray:
+        order = np.argsort(lengths, kind="stable")[::-1]
+        result = None
+
+        for start in range(0, len(order), self.batch_size):
+            bucket = order[start : start + self.batch_size]
+            vectors = self.model.encode(
+                [texts[i] for i in bucket], batch_size=self.batch_size
+            )
+
+            if result is None:
+                result = np.empty((len(texts), vectors.shape[1]), dtype=vectors.dtype)
+
+            result[bucket] = vectors
 
-        return list(zip(ids, result.tolist()))
+        return result
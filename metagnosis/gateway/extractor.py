@@ -0,0 +1,111 @@
+from asyncio import gather, get_running_loop
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import cpu_count, get_context
+from time import perf_counter
+from .text import TextGateway
+from ..config import get_config, Config
+from ..log import log
+from ..models.pdf import PDF
+from ..util.metrics import extract_page_seconds, pages_extracted
+
+
+def extract_pages(path: str, start: int, end: int) -> tuple[int, str]:
+    from pymupdf import open as open_pdf
+
+    with open_pdf(path) as f:
+        pages = len(f)
+
+        return pages, "".join([f[i].get_text() for i in range(start, min(end, pages))])
+
+
+class ExtractionGateway:
+    config: Config
+    text: TextGateway
+    pages_per_task: int
+    pool: ProcessPoolExecutor
+
+    def __init__(self, text: TextGateway):
+        self.config = get_config()
+        self.text = text
+        self.pages_per_task = self.config.extract_pages_per_task
+        self.pool = self.new_pool()
+
+    def new_pool(self) -> ProcessPoolExecutor:
+        # Forking after torch has started its threads is unsafe
+        return ProcessPoolExecutor(
+            max_workers=self.config.extract_workers or cpu_count(),
+            mp_context=get_context("spawn"),
+        )
+
+    async def extract(self, path: str) -> tuple[int, str]:
+        loop = get_running_loop()
+        step = self.pages_per_task
+
+        try:
+            pages, first = await loop.run_in_executor(
+                self.pool, extract_pages, path, 0, step
+            )
+            rest = await gather(
+                *(
+                    loop.run_in_executor(self.pool, extract_pages, path, i, i + step)
+                    for i in range(step, pages, step)
+                )
+            )
+        except BrokenProcessPool:
+            log.info("Extraction pool died, restarting it")
+            self.pool = self.new_pool()
+            raise
+
+        return pages, "".join([first] + [text for _, text in rest])
+
+    async def hydrate(
+        self, pdfs: list[PDF]
+    ) -> tuple[dict[str, tuple[int, float]], dict[str, Exception]]:
+        keys = {p.id: p.hash or p.id for p in pdfs}
+        stored = await self.text.get_texts(list(set(keys.values())))
+        missing = []
+
+        for pdf in pdfs:
+            if keys[pdf.id] in stored:
+                pdf.text = stored[keys[pdf.id]]
+            else:
+                missing.append(pdf)
+
+        log.info(f"Found stored text for {len(pdfs) - len(missing)} PDFs")
+
+        results = await gather(
+            *(self.hydrate_pdf(p) for p in missing), return_exceptions=True
+        )
+        timings = {}
+        errors = {}
+
+        # One unreadable file must not fail the rest of the batch
+        for pdf, result in zip(missing, results):
+            if isinstance(result, Exception):
+                log.info(f"Failed to extract {pdf.id}: {result!r}")
+                errors[pdf.id] = result
+            else:
+                timings[pdf.id] = result
+
+        await self.text.save_texts(
+            {keys[p.id]: p.text for p in missing if p.id in timings}
+        )
+
+        return timings, errors
+
+    async def hydrate_pdf(self, pdf: PDF) -> tuple[int, float]:
+        start = perf_counter()
+        pages, pdf.text = await self.extract(pdf.path)
+        elapsed = perf_counter() - start
+
+        log.info(f"Extracted {pages} pages from {pdf.id} in {elapsed:.2f}s")
+        pages_extracted.inc(pages)
+
+        if pages:
+            extract_page_seconds.observe(elapsed / pages)
+
+        return pages, elapsed
+
+    def close(self, wait: bool = True):
+        self.pool.shutdown(wait=wait, cancel_futures=True)
@@ -0,0 +1,61 @@
+from datetime import datetime
+from json import dumps, loads
+from typing import Optional
+from .data_gateway import StorageGateway
+from ..models.feed import Feed
+
+
+class FeedGateway(StorageGateway):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS feed (
+            url TEXT PRIMARY KEY,
+            etag TEXT,
+            last_modified TEXT,
+            digest TEXT,
+            entries TEXT NOT NULL,
+            updated DATETIME NOT NULL
+        );
+    """
+
+    async def get_feed(self, url: str) -> Optional[Feed]:
+        query = """
+            SELECT
+                url, etag, last_modified, digest, entries, updated
+            FROM feed
+            WHERE url = ?
+        """
+
+        async with self.db.execute(query, (url,)) as cursor:
+            row = await cursor.fetchone()
+
+        if row is None:
+            return None
+
+        return Feed(
+            url=row[0],
+            etag=row[1],
+            last_modified=row[2],
+            digest=row[3],
+            entries=loads(row[4]),
+            updated=row[5],
+        )
+
+    async def save_feed(self, feed: Feed):
+        query = """
+            INSERT OR REPLACE INTO feed
+            (url, etag, last_modified, digest, entries, updated)
+            VALUES
+            (?, ?, ?, ?, ?, ?)
+        """
+
+        await self.writer.write(
+            query,
+            (
+                feed.url,
+                feed.etag,
+                feed.last_modified,
+                feed.digest,
+                dumps(sorted(feed.entries)),
+                datetime.now(),
+            ),
+        )
@@ -0,0 +1,137 @@
+from asyncio import sleep, timeout
+from time import perf_counter
+from datetime import datetime, UTC
+from email.utils import parsedate_to_datetime
+from random import uniform
+from typing import Awaitable, Callable, Optional, TypeVar
+from urllib.parse import urlsplit
+from aiohttp import (
+    ClientConnectionError,
+    ClientPayloadError,
+    ClientResponse,
+    ClientSession,
+    ClientTimeout,
+    TCPConnector,
+)
+from ..config import get_config, Config
+from ..log import log
+from ..util.metrics import http_latency, http_requests
+from ..util.rate_limit import TokenBucket
+
+T = TypeVar("T")
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+THROTTLE_STATUSES = {429, 503}
+
+
+class HTTPGateway:
+    config: Config
+    buckets: dict[str, TokenBucket]
+    _session: Optional[ClientSession]
+
+    def __init__(self):
+        self.config = get_config()
+        self.buckets = {}
+        self._session = None
+
+    @property
+    def session(self) -> ClientSession:
+        if self._session is None or self._session.closed:
+            connector = TCPConnector(
+                limit=self.config.http_limit,
+                limit_per_host=self.config.http_limit_per_host,
+                ttl_dns_cache=self.config.http_dns_ttl,
+                keepalive_timeout=self.config.http_keepalive,
+            )
+            # Waiting for a pool slot is not bounded, http_total_timeout
+            # starts once a response arrives in fetch
+            timeouts = ClientTimeout(
+                total=None,
+                sock_connect=self.config.http_connect_timeout,
+                sock_read=self.config.http_read_timeout,
+            )
+            self._session = ClientSession(connector=connector, timeout=timeouts)
+
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    def bucket(self, url: str) -> TokenBucket:
+        host = urlsplit(url).hostname or ""
+
+        if host not in self.buckets:
+            self.buckets[host] = TokenBucket(
+                self.config.host_rate, self.config.host_burst
+            )
+
+        return self.buckets[host]
+
+    def backoff(self, attempt: int) -> float:
+        limit = min(
+            self.config.fetch_backoff_max, self.config.fetch_backoff * 2**attempt
+        )
+
+        return uniform(0, limit)
+
+    def retry_after(self, response: ClientResponse) -> Optional[float]:
+        value = response.headers.get("Retry-After")
+
+        if not value:
+            return None
+
+        if value.isdigit():
+            seconds = float(value)
+        else:
+            try:
+                seconds = (
+                    parsedate_to_datetime(value) - datetime.now(UTC)
+                ).total_seconds()
+            except (TypeError, ValueError):
+                return None
+
+        return min(max(seconds, 0), self.config.fetch_backoff_max)
+
+    async def fetch(
+        self,
+        method: str,
+        url: str,
+        consume: Callable[[ClientResponse], Awaitable[T]],
+        **kwargs,
+    ) -> T:
+        bucket = self.bucket(url)
+        retries = self.config.fetch_retries
+
+        for attempt in range(retries):
+            last = attempt + 1 == retries
+            await bucket.acquire()
+            start = perf_counter()
+
+            try:
+                async with self.session.request(method, url, **kwargs) as response:
+                    http_latency.observe(perf_counter() - start, method=method)
+                    http_requests.inc(method=method, status=response.status)
+
+                    if last or response.status not in RETRY_STATUSES:
+                        async with timeout(self.config.http_total_timeout):
+                            return await consume(response)
+
+                    delay = self.retry_after(response)
+
+                    if delay is None:
+                        delay = self.backoff(attempt)
+
+                    if response.status in THROTTLE_STATUSES:
+                        bucket.pause(delay)
+
+                    log.info(f"{url} returned {response.status}, retrying")
+            except (ClientConnectionError, ClientPayloadError, TimeoutError) as e:
+                http_requests.inc(method=method, status=e.__class__.__name__)
+
+                if last:
+                    raise e
+
+                delay = self.backoff(attempt)
+                log.info(f"{url} failed with {e.__class__.__name__}, retrying")
+
+            await sleep(delay)
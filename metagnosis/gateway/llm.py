@@ -1,10 +1,22 @@
 from asyncio import get_running_loop
 from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from hashlib import sha256
 from json import loads
-from typing import Any
-from transformers import pipeline, Pipeline
+from re import sub
+from threading import Lock
+from typing import Any, List, Optional, Tuple, TYPE_CHECKING
+from .metadata import MetadataGateway
+from ..config import get_config, Config
+from ..log import log
 from ..models.metadata import Metadata
+from ..util.timing import timed
 
+if TYPE_CHECKING:
+    from transformers import DynamicCache, PreTrainedModel, PreTrainedTokenizer
+
+# Bump whenever METADATA_PROMPT changes so stored metadata is regenerated
+PROMPT_VERSION = 1
 METADATA_PROMPT = """
 Given a body of text, extract the title and tags related to it. Try to keep tag
 values down to a single word. Use high level categories as much as possible and
@@ -19,39 +31,246 @@ Return the data in json in the following format:
 
 
 class LLMGateway:
+    # Upper bound on characters per token, used to cut text before tokenizing
+    CHARS_PER_TOKEN = 8
+    config: Config
+    store: MetadataGateway
     model_name: str
     model_parameters: dict[str, Any]
-    pipe: Pipeline
+    batch_size: int
+    max_input_tokens: int
     pool: ThreadPoolExecutor
+    _model: Optional["PreTrainedModel"]
+    _tokenizer: Optional["PreTrainedTokenizer"]
+    prefix: Optional[str]
+    prefix_ids: Optional[List[int]]
+    prefix_cache: Optional["DynamicCache"]
 
-    def __init__(self):
-        self.pool = ThreadPoolExecutor(max_workers=4)
+    def __init__(self, store: MetadataGateway):
+        self.config = get_config()
+        self.store = store
         self.model_name = "microsoft/Phi-3.5-mini-instruct"
         self.model_parameters = {
-            "max_new_tokens": 150,
-            "return_full_text": True,
-            "temperature": 0.0,
+            "max_new_tokens": self.config.llm_max_new_tokens,
             "do_sample": False,
         }
-        self.pipe = pipeline(
-            "text-generation", model=self.model_name, trust_remote_code=True
-        )
+        self.batch_size = self.config.llm_batch_size
+        self.max_input_tokens = self.config.llm_max_input_tokens
+        # Generation is compute bound, batches run one after another
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        self.model_lock = Lock()
+        self._model = None
+        self._tokenizer = None
+        self.prefix = None
+        self.prefix_ids = None
+        self.prefix_cache = None
 
-    async def extract_metadata(self, text: str) -> Metadata:
-        loop = get_running_loop()
+    @property
+    def model(self) -> "PreTrainedModel":
+        self.load()
+
+        return self._model
+
+    @property
+    def tokenizer(self) -> "PreTrainedTokenizer":
+        self.load()
+
+        return self._tokenizer
+
+    def load(self):
+        with self.model_lock:
+            if self._model is not None:
+                return
+
+            with timed(f"Loading {self.model_name}"):
+                from transformers import AutoModelForCausalLM, AutoTokenizer
+
+                tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+                model = AutoModelForCausalLM.from_pretrained(
+                    self.model_name, torch_dtype="auto"
+                )
+                model.eval()
+
+                if tokenizer.pad_token_id is None:
+                    tokenizer.pad_token = tokenizer.eos_token
+
+                self._tokenizer = tokenizer
+                self._model = model
+                self.build_prefix()
+
+    def render(self, text: str) -> str:
         messages = [
             {"role": "system", "content": METADATA_PROMPT},
             {"role": "user", "content": text},
         ]
-        result = loop.run_in_executor(
-            self.pool, self.pipe, messages, **self.model_parameters
+
+        return self._tokenizer.apply_chat_template(
+            messages, tokenize=False, add_generation_prompt=True
         )
-        message = result[-1]
 
-        if message["role"] != "assistant":
-            raise TypeError("Response was not from assistant")
+    def build_prefix(self):
+        from torch import inference_mode, tensor
+        from transformers import DynamicCache
+
+        # Everything before the user content is shared by every prompt
+        first, second = self.render("\0"), self.render("\1")
+        end = next(i for i, (a, b) in enumerate(zip(first, second)) if a != b)
+        self.prefix = first[:end]
+        self.prefix_ids = self._tokenizer(self.prefix, add_special_tokens=False)[
+            "input_ids"
+        ]
+
+        with inference_mode():
+            self.prefix_cache = self._model(
+                tensor([self.prefix_ids]),
+                past_key_values=DynamicCache(),
+                use_cache=True,
+            ).past_key_values
+
+    async def get_missing(self, limit: int) -> list[tuple[str, str]]:
+        return await self.store.get_missing(self.model_name, PROMPT_VERSION, limit)
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+    async def extract_metadata(self, id: str, text: str) -> Optional[Metadata]:
+        return (await self.extract_metadata_many([(id, text)]))[0]
+
+    async def extract_metadata_many(
+        self, values: List[Tuple[str, str]]
+    ) -> List[Optional[Metadata]]:
+        if not values:
+            return []
+
+        keys = [(id, sha256(text.encode("utf-8")).hexdigest()) for id, text in values]
+        stored = await self.store.get_metadata(self.model_name, PROMPT_VERSION, keys)
+        missing = {}
+
+        for key, (_, text) in zip(keys, values):
+            if key not in stored:
+                missing[key] = text
+
+        log.info(f"Found stored metadata for {len(values) - len(missing)} texts")
+
+        if missing:
+            generated = await self.generate_metadata(list(missing.values()))
+            generated = dict(zip(missing, generated))
+
+            await self.store.save_metadata(self.model_name, PROMPT_VERSION, generated)
+            stored.update(generated)
+
+        return [stored[key] for key in keys]
+
+    async def generate_metadata(self, texts: List[str]) -> List[Optional[Metadata]]:
+        log.info(f"Extracting metadata for {len(texts)} texts")
+
+        loop = get_running_loop()
+        suffixes = await loop.run_in_executor(self.pool, self.tokenize, texts)
+        order = sorted(range(len(texts)), key=lambda i: len(suffixes[i]), reverse=True)
+        result: List[Optional[Metadata]] = [None] * len(texts)
+
+        for start in range(0, len(order), self.batch_size):
+            bucket = order[start : start + self.batch_size]
+            outputs = await loop.run_in_executor(
+                self.pool, self.generate, [suffixes[i] for i in bucket]
+            )
+
+            for i, output in zip(bucket, outputs):
+                result[i] = self.parse(output)
+
+        return result
+
+    def tokenize(self, texts: List[str]) -> List[List[int]]:
+        tokenizer = self.tokenizer
+        limit = self.max_input_tokens * self.CHARS_PER_TOKEN
+        suffixes = []
+
+        for text in texts:
+            ids = tokenizer(text[:limit], add_special_tokens=False)["input_ids"]
+            text = tokenizer.decode(ids[: self.max_input_tokens])
+            # The rendered prefix is fixed, only the remainder is tokenized
+            suffix = self.render(text)[len(self.prefix) :]
+            suffixes.append(tokenizer(suffix, add_special_tokens=False)["input_ids"])
+
+        return suffixes
+
+    def generate(self, suffixes: List[List[int]]) -> List[str]:
+        from torch import inference_mode, tensor
+
+        width = max(len(s) for s in suffixes)
+        pad = self.tokenizer.pad_token_id
+        prefix = self.prefix_ids
+        input_ids = []
+        attention_mask = []
+
+        # Padding sits between the cached prefix and each suffix
+        for suffix in suffixes:
+            padding = width - len(suffix)
+            input_ids.append(prefix + [pad] * padding + suffix)
+            attention_mask.append([1] * len(prefix) + [0] * padding + [1] * len(suffix))
+
+        with inference_mode():
+            cache = deepcopy(self.prefix_cache)
+            cache.batch_repeat_interleave(len(suffixes))
+            output = self.model.generate(
+                input_ids=tensor(input_ids),
+                attention_mask=tensor(attention_mask),
+                past_key_values=cache,
+                pad_token_id=pad,
+                **self.model_parameters,
+            )
+
+        return self.tokenizer.batch_decode(
+            output[:, len(prefix) + width :], skip_special_tokens=True
+        )
+
+    def parse(self, output: str) -> Optional[Metadata]:
+        contents = output.replace("```json", "").replace("```", "").strip()
+        start = contents.find("{")
+
+        if start < 0:
+            log.error(f"No JSON object in response: {output!r}")
+            return None
+
+        contents = contents[start:]
+        end = contents.rfind("}")
+
+        try:
+            return Metadata(**loads(contents[: end + 1]))
+        except (ValueError, TypeError):
+            pass
+
+        # One repair pass rather than another generation
+        try:
+            return Metadata(**loads(self.repair(contents)))
+        except (ValueError, TypeError) as e:
+            log.error(f"Unable to parse metadata: {e}")
+            return None
+
+    def repair(self, contents: str) -> str:
+        closing = []
+        quoted = escaped = False
+        end = len(contents)
+
+        # Close strings and brackets left open by a truncated generation
+        for i, c in enumerate(contents):
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = quoted
+            elif c == '"':
+                quoted = not quoted
+            elif quoted:
+                continue
+            elif c in "{[":
+                closing.append("}" if c == "{" else "]")
+            elif c in "}]" and closing:
+                closing.pop()
+
+                if not closing:
+                    end = i + 1
+                    break
 
-        contents = message["content"].replace("```", "").strip()
-        message = loads(contents)
+        contents = contents[:end] + ('"' if quoted else "") + "".join(reversed(closing))
 
-        return Metadata(**message)
+        return sub(r",\s*([}\]])", r"\1", contents)
@@ -0,0 +1,100 @@
+from datetime import datetime
+from json import dumps, loads
+from typing import Optional
+from .data_gateway import StorageGateway
+from ..log import log
+from ..models.metadata import Metadata
+
+
+class MetadataGateway(StorageGateway):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS metadata (
+            id TEXT NOT NULL,
+            hash TEXT NOT NULL,
+            model TEXT NOT NULL,
+            prompt_version INT NOT NULL,
+            title TEXT,
+            tags TEXT,
+            created DATETIME NOT NULL,
+            PRIMARY KEY (id, hash, model, prompt_version)
+        );
+    """
+
+    async def get_missing(
+        self, model: str, prompt_version: int, limit: int
+    ) -> list[tuple[str, str]]:
+        query = """
+            SELECT d.id, t.key
+            FROM document d
+            JOIN pdf p ON p.id = d.id
+            JOIN pdf_text t ON t.key = COALESCE(p.hash, p.id)
+            LEFT JOIN metadata m
+            ON m.id = d.id
+            AND m.model = ?
+            AND m.prompt_version = ?
+            WHERE m.id IS NULL
+            ORDER BY d.created DESC
+            LIMIT ?
+        """
+
+        async with self.db.execute(query, (model, prompt_version, limit)) as cursor:
+            return [(row[0], row[1]) async for row in cursor]
+
+    async def get_metadata(
+        self, model: str, prompt_version: int, keys: list[tuple[str, str]]
+    ) -> dict[tuple[str, str], Optional[Metadata]]:
+        if not keys:
+            return {}
+
+        placeholders = ",".join(["(?, ?)" for _ in keys])
+        query = f"""
+            SELECT id, hash, title, tags
+            FROM metadata
+            WHERE model = ?
+            AND prompt_version = ?
+            AND (id, hash) IN (VALUES {placeholders})
+        """
+        params = [model, prompt_version] + [v for key in keys for v in key]
+
+        async with self.db.execute(query, params) as cursor:
+            # A null title records a failed extraction, it is not retried
+            return {
+                (id, hash): (
+                    Metadata(title=title, tags=loads(tags))
+                    if title is not None
+                    else None
+                )
+                async for id, hash, title, tags in cursor
+            }
+
+    async def save_metadata(
+        self,
+        model: str,
+        prompt_version: int,
+        metadata: dict[tuple[str, str], Optional[Metadata]],
+    ):
+        if not metadata:
+            return
+
+        query = """
+            INSERT OR REPLACE INTO metadata
+            (id, hash, model, prompt_version, title, tags, created)
+            VALUES
+            (?, ?, ?, ?, ?, ?, ?)
+        """
+        now = datetime.now()
+        rows = [
+            (
+                id,
+                hash,
+                model,
+                prompt_version,
+                m.title if m else None,
+                dumps(m.tags) if m else None,
+                now,
+            )
+            for (id, hash), m in metadata.items()
+        ]
+
+        log.info(f"Storing metadata for {len(rows)} documents")
+        self.writer.submit(query, rows, many=True)
@@ -0,0 +1,38 @@
+from json import dumps
+from time import time
+from .data_gateway import StorageGateway
+from ..util.metrics import Sample
+
+
+class MetricsGateway(StorageGateway):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS metric_snapshot (
+            created INT NOT NULL,
+            name TEXT NOT NULL,
+            labels TEXT NOT NULL,
+            value REAL NOT NULL
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_metric_snapshot_created
+        ON metric_snapshot (created);
+    """
+
+    async def save_snapshot(self, samples: list[Sample]):
+        if not samples:
+            return
+
+        query = """
+            INSERT INTO metric_snapshot
+            (created, name, labels, value)
+            VALUES
+            (?, ?, ?, ?)
+        """
+        prune = "DELETE FROM metric_snapshot WHERE created < ?"
+        now = int(time())
+        rows = [
+            (now, name, dumps(labels, sort_keys=True), value)
+            for name, labels, value in samples
+        ]
+
+        self.writer.submit(query, rows, many=True)
+        self.writer.submit(prune, (now - self.config.metrics_retention,))
@@ -1,19 +1,32 @@
-from asyncio import Semaphore
-from contextlib import asynccontextmanager
+from asyncio import gather, Lock, Semaphore
 from datetime import datetime
-from os import remove
-from os.path import join
-from typing import AsyncGenerator, List, Optional
+from hashlib import sha256
+from os import makedirs, remove, replace
+from os.path import dirname, getsize, join
+from time import perf_counter, time
+from typing import List, Optional, Tuple
 from uuid import uuid4
-from aiohttp import ClientSession
-from aiohttp.client_exceptions import ClientResponseError, ServerDisconnectedError
+from aiohttp import ClientError, ClientResponse, ClientResponseError
 from aiofiles import open
+from aiosqlite import Connection
 from .data_gateway import StorageGateway
+from .http import HTTPGateway
+from .write_queue import WriteQueue
 from ..models.pdf import PDF
 from ..log import log
+from ..util.metrics import download_bytes, download_latency, download_size, downloads
+
+PDF_SIGNATURE = b"%PDF-"
+REJECTED_CONTENT_TYPES = ("text/", "image/", "audio/", "video/")
+
+
+class InvalidPDF(Exception):
+    pass
 
 
 class PDFGateway(StorageGateway):
+    WRITE_BUFFER = 1 << 20
+    http: HTTPGateway
     SCHEMA = """
         CREATE TABLE IF NOT EXISTS pdf (
             id TEXT PRIMARY KEY,
@@ -25,73 +38,190 @@ class PDFGateway(StorageGateway):
             error STR,
             created DATETIME NOT NULL,
             updated DATETIME NOT NULL,
-            processed BOOLEAN NOT NULL
+            processed BOOLEAN NOT NULL,
+            duplicate_of TEXT,
+            hash TEXT,
+            claimed_by TEXT,
+            lease_expires INT
         );
 
         CREATE INDEX IF NOT EXISTS idx_pdf_processed ON PDF (processed);
         CREATE INDEX IF NOT EXISTS idx_pdf_created ON PDF (created);
         CREATE INDEX IF NOT EXISTS idx_pdf_url ON PDF (url);
+
+        CREATE TABLE IF NOT EXISTS pdf_alias (
+            url TEXT PRIMARY KEY,
+            pdf_id TEXT NOT NULL
+        );
     """
+    COLUMNS = {
+        "duplicate_of": "TEXT",
+        "hash": "TEXT",
+        "claimed_by": "TEXT",
+        "lease_expires": "INT",
+    }
+
+    def __init__(
+        self,
+        db: Connection,
+        storage_path: str,
+        process_lock: Lock,
+        writer: WriteQueue,
+        http: HTTPGateway,
+    ):
+        super().__init__(db, storage_path, process_lock, writer)
+        self.http = http
+
+    async def migrate(self):
+        columns = await self.columns("pdf")
+
+        for name, type in self.COLUMNS.items():
+            if name not in columns:
+                await self.db.execute(f"ALTER TABLE pdf ADD COLUMN {name} {type}")
+
+        await self.db.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_pdf_hash ON pdf (hash)"
+        )
+        await self.db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_pdf_lease ON pdf (processed, lease_expires)"
+        )
+        await self.db.commit()
 
-    @asynccontextmanager
-    async def get_pdfs_for_processing(
-        self, limit=None
-    ) -> AsyncGenerator[List[PDF], None]:
-        async with self.transaction():
-            log.info("Retrieving pdfs from the queue for processing")
-            pdfs = await self._get_pdfs(limit=limit)
+    def content_path(self, digest: str) -> str:
+        return join(self.storage_path, "pdf", digest[:2], digest[2:4], digest)
 
-            yield pdfs
+    async def claim_pdfs(self, worker: str, limit: int) -> List[PDF]:
+        now = int(time())
+        query = """
+        UPDATE
+            pdf
+        SET claimed_by = ?,
+        lease_expires = ?
+        WHERE id IN (
+            SELECT id
+            FROM pdf
+            WHERE processed = FALSE
+            AND (lease_expires IS NULL OR lease_expires < ?)
+            ORDER BY created DESC
+            LIMIT ?
+        )
+        RETURNING
+            id, path, url, title, score, error, created, updated, processed, origin,
+            hash
+        """
+
+        # Short and on its own, so other workers only ever wait for the claim
+        async with self.process_lock:
+            try:
+                async with self.db.execute(
+                    query, (worker, now + self.config.pdf_lease, now, limit)
+                ) as cursor:
+                    rows = await cursor.fetchall()
 
-            log.info("Deleting pdfs from the queue")
-            await self._delete_pdfs([i.id for i in pdfs])
+                await self.db.commit()
+            except Exception as e:
+                await self.db.rollback()
+                raise e
 
-    async def _delete_pdfs(self, ids: list[str]):
+        if rows:
+            log.info(f"Claimed {len(rows)} pdfs for processing")
+
+        return [self._to_pdf(row) for row in rows]
+
+    def renew_leases(self, worker: str, ids: list[str]):
         placeholders = ",".join(["?" for _ in ids])
         query = f"""
+        UPDATE
+            pdf
+        SET lease_expires = ?
+        WHERE id IN ({placeholders})
+        AND claimed_by = ?
+        """
+
+        self.writer.submit(
+            query, [int(time()) + self.config.pdf_lease] + ids + [worker]
+        )
+
+    def release_pdfs(self, worker: str, ids: list[str]):
+        placeholders = ",".join(["?" for _ in ids])
+        query = f"""
+        UPDATE
+            pdf
+        SET claimed_by = NULL,
+        lease_expires = NULL
+        WHERE id IN ({placeholders})
+        AND claimed_by = ?
+        """
+
+        self.writer.submit(query, ids + [worker])
+
+    async def fail_pdfs(self, worker: str, errors: dict[str, str]):
+        query = """
         UPDATE
             pdf
         SET processed = TRUE,
+        error = ?,
+        claimed_by = NULL,
+        lease_expires = NULL,
+        updated = CURRENT_TIMESTAMP
+        WHERE id = ?
+        AND claimed_by = ?
+        """
+
+        await self.writer.write(
+            query, [(error, id, worker) for id, error in errors.items()], many=True
+        )
+
+    async def complete_pdfs(self, worker: str, ids: list[str]):
+        placeholders = ",".join(["?" for _ in ids])
+        query = f"""
+        UPDATE
+            pdf
+        SET processed = TRUE,
+        claimed_by = NULL,
+        lease_expires = NULL,
         updated = CURRENT_TIMESTAMP
         WHERE id IN ({placeholders})
+        AND claimed_by = ?
         """
 
-        await self.db.execute(query, ids)
+        await self.db.execute(query, ids + [worker])
 
-    async def _get_pdfs(self, limit=None) -> List[PDF]:
+    async def mark_duplicates(self, duplicates: dict[str, str]):
         query = """
-            SELECT
-                id, path, url, title, score, error, created, updated, processed, origin
-            FROM
-                pdf
-            WHERE
-                processed = FALSE
-            ORDER BY created DESC 
+        UPDATE
+            pdf
+        SET duplicate_of = ?,
+        updated = CURRENT_TIMESTAMP
+        WHERE id = ?
         """
 
-        if limit:
-            query += f"\n LIMIT {limit}"
+        await self.db.executemany(
+            query, [(original, id) for id, original in duplicates.items()]
+        )
 
-        results = []
+    async def count_unprocessed(self) -> int:
+        query = "SELECT COUNT(*) FROM pdf WHERE processed = FALSE"
 
         async with self.db.execute(query) as cursor:
-            async for row in cursor:
-                results.append(
-                    PDF(
-                        id=row[0],
-                        path=row[1],
-                        url=row[2],
-                        title=row[3],
-                        score=row[4],
-                        error=row[5],
-                        created=row[6],
-                        updated=row[7],
-                        processed=row[8],
-                        origin=row[9],
-                    )
-                )
-
-        return results
+            row = await cursor.fetchone()
+
+        return row[0]
+
+    def _to_pdf(self, row: tuple) -> PDF:
+        return PDF(
+            id=row[0],
+            path=row[1],
+            url=row[2],
+            title=row[3],
+            score=row[4],
+            error=row[5],
+            created=row[6],
+            updated=row[7],
+            processed=row[8],
+            origin=row[9],
+            hash=row[10],
+        )
 
     async def download_pdf(
         self,
@@ -101,99 +231,205 @@ class PDFGateway(StorageGateway):
         title: str = None,
         score: int = None,
     ):
-        log.info(f"Downloading PDF {url}")
+        await self.download_pdfs([(url, title, score)], origin, sem)
 
-        if await self.pdf_exists(url):
-            await self.update_pdf(url, title=title, score=score)
-            return
+    async def download_pdfs(
+        self,
+        entries: List[Tuple[str, Optional[str], Optional[int]]],
+        origin: str,
+        sem: Optional[Semaphore] = None,
+    ) -> int:
+        entries = {url: (url, title, score) for url, title, score in entries}
+        new_urls = await self.filter_new_urls(list(entries))
+        existing = [e for url, e in entries.items() if url not in new_urls]
+
+        if existing:
+            await self.update_pdfs(existing)
+
+        log.info(f"Downloading {len(new_urls)} PDFs")
+
+        urls = list(new_urls)
+        results = await gather(
+            *(self._download_pdf_limited(entries[url], origin, sem) for url in urls),
+            return_exceptions=True,
+        )
+        pdfs = []
+
+        # Keep the downloads that succeeded even if others blew up
+        for url, result in zip(urls, results):
+            if isinstance(result, Exception):
+                log.info(f"Failed to download {url}: {result!r}")
+            elif result:
+                pdfs.append(result)
+
+        await self.add_pdfs(pdfs)
+
+        return len(pdfs)
+
+    async def _download_pdf_limited(
+        self,
+        entry: Tuple[str, Optional[str], Optional[int]],
+        origin: str,
+        sem: Optional[Semaphore],
+    ) -> Optional[PDF]:
+        url, title, score = entry
+        log.info(f"Downloading PDF {url}")
 
         if sem:
             async with sem:
-                await self._download_pdf(url, origin, title=title, score=score)
+                return await self._download_pdf(url, origin, title=title, score=score)
         else:
-            await self._download_pdf(url, origin, title=title, score=score)
+            return await self._download_pdf(url, origin, title=title, score=score)
 
     async def _download_pdf(
         self, url: str, origin: str, title: str = None, score: int = None
-    ):
+    ) -> Optional[PDF]:
         pdf_id = str(uuid4())
-        path = join(self.storage_path, pdf_id)
+        temp_path = join(self.storage_path, "tmp", pdf_id)
         now = datetime.now()
 
         headers = {"User-Agent": self.config.user_agent}
-
-        for _ in range(self.config.fetch_retries):
+        makedirs(dirname(temp_path), exist_ok=True)
+        start = perf_counter()
+
+        try:
+            digest = await self.http.fetch(
+                "GET",
+                url,
+                lambda response: self.save_response(response, temp_path),
+                headers=headers,
+                proxy=self.config.proxy,
+            )
+            size = getsize(temp_path)
+            path = self.content_path(digest)
+            makedirs(dirname(path), exist_ok=True)
+            replace(temp_path, path)
+        except InvalidPDF as e:
+            log.info(f"{url} is not PDF, skipping: {e}")
+            downloads.inc(origin=origin, status="invalid")
+            return None
+        except ClientResponseError as e:
+            log.info(f"{url} {e.status}")
+            downloads.inc(origin=origin, status=e.status)
+            return None
+        except (ClientError, TimeoutError) as e:
+            log.info(f"Failed to download {url}: {e.__class__.__name__}")
+            downloads.inc(origin=origin, status=e.__class__.__name__)
+            return None
+        finally:
             try:
-                async with ClientSession() as client:
-                    async with client.get(
-                        url, headers=headers, proxy=self.config.proxy
-                    ) as response:
-                        response.raise_for_status()
-                        log.info(f"Saving {url} to {path}")
-
-                        async with open(path, "wb") as f:
-                            async for chunk in response.content.iter_any():
-                                await f.write(chunk)
-
-                break
-            except ServerDisconnectedError:
+                remove(temp_path)
+            except FileNotFoundError:
                 pass
-            except ClientResponseError as e:
-                if e.status == 404:
-                    log.info(f"{url} 404")
-                    return
 
-        if not await self.is_pdf(path):
-            log.info(f"{url} is not PDF, skipping")
+        downloads.inc(origin=origin, status="ok")
+        download_bytes.inc(size, origin=origin)
+        download_size.observe(size, origin=origin)
+        download_latency.observe(perf_counter() - start, origin=origin)
+
+        return PDF(
+            id=pdf_id,
+            path=path,
+            url=url,
+            origin=origin,
+            title=title,
+            score=score,
+            created=now,
+            updated=now,
+            processed=False,
+            hash=digest,
+        )
 
-            try:
-                remove(path)
-            except:
-                pass
+    async def save_response(self, response: ClientResponse, path: str) -> str:
+        response.raise_for_status()
 
-            return
+        max_size = self.config.max_pdf_size
+        content_type = response.content_type
 
-        await self.add_pdf(
-            PDF(
-                id=pdf_id,
-                path=path,
-                url=url,
-                origin=origin,
-                title=title,
-                score=score,
-                created=now,
-                updated=now,
-                processed=False,
-            )
-        )
+        if content_type.startswith(REJECTED_CONTENT_TYPES):
+            raise InvalidPDF(f"content type {content_type}")
+
+        if response.content_length and response.content_length > max_size:
+            raise InvalidPDF(f"{response.content_length} bytes")
+
+        content_hash = sha256()
+        buffer = bytearray()
+        size = 0
+        f = None
+
+        try:
+            async for chunk in response.content.iter_any():
+                size += len(chunk)
+
+                if size > max_size:
+                    raise InvalidPDF(f"more than {max_size} bytes")
+
+                content_hash.update(chunk)
+                buffer += chunk
+
+                if f is None:
+                    if len(buffer) < len(PDF_SIGNATURE):
+                        continue
 
-    async def is_pdf(self, path):
-        async with open(path, "rb") as f:
-            signature = await f.read(5)
+                    if not buffer.startswith(PDF_SIGNATURE):
+                        raise InvalidPDF("missing PDF signature")
 
-            return signature == b"%PDF-"
+                    log.info(f"Saving {response.url} to {path}")
+                    f = await open(path, "wb")
+
+                if len(buffer) >= self.WRITE_BUFFER:
+                    await f.write(buffer)
+                    buffer.clear()
+
+            if f is None:
+                raise InvalidPDF("missing PDF signature")
+
+            await f.write(buffer)
+        finally:
+            if f is not None:
+                await f.close()
+
+        return content_hash.hexdigest()
 
     async def pdf_exists(self, url) -> bool:
-        query = """
-            SELECT 1 FROM pdf WHERE url = ?
+        return not await self.filter_new_urls([url])
+
+    async def filter_new_urls(self, urls: list[str]) -> set[str]:
+        if not urls:
+            return set()
+
+        placeholders = ",".join(["?" for _ in urls])
+        query = f"""
+            SELECT url FROM pdf WHERE url IN ({placeholders})
+            UNION
+            SELECT url FROM pdf_alias WHERE url IN ({placeholders})
         """
 
-        async with self.db.execute(query, (url,)) as cursor:
-            result = await cursor.fetchone()
+        async with self.db.execute(query, urls + urls) as cursor:
+            known = {row[0] async for row in cursor}
 
-        return result is not None
+        return set(urls) - known
 
     async def add_pdf(self, pdf: PDF):
+        await self.add_pdfs([pdf])
+
+    async def add_pdfs(self, pdfs: list[PDF]):
+        if not pdfs:
+            return
+
         query = """
             INSERT OR IGNORE INTO pdf
-            (id, path, url, title, score, error, created, updated, processed, origin)
+            (id, path, url, title, score, error, created, updated, processed, origin,
+            hash)
             VALUES
-            (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         """
-
-        log.info(f"Saving PDF metadata {pdf.id}")
-        await self.db.execute(
-            query,
+        alias_query = """
+            INSERT OR IGNORE INTO pdf_alias
+            (url, pdf_id)
+            SELECT ?, id FROM pdf WHERE hash = ? AND url != ?
+        """
+        rows = [
             (
                 pdf.id,
                 pdf.path,
@@ -205,19 +441,34 @@ class PDFGateway(StorageGateway):
                 pdf.updated,
                 pdf.processed,
                 pdf.origin,
-            ),
-        )
-        await self.db.commit()
+                pdf.hash,
+            )
+            for pdf in pdfs
+        ]
+        aliases = [(pdf.url, pdf.hash, pdf.url) for pdf in pdfs if pdf.hash]
+
+        log.info(f"Saving metadata for {len(pdfs)} PDFs")
+        await self.writer.write_all([(query, rows, True), (alias_query, aliases, True)])
 
     async def update_pdf(self, url: str, title: str = None, score: int = None):
+        await self.update_pdfs([(url, title, score)])
+
+    async def update_pdfs(
+        self, entries: List[Tuple[str, Optional[str], Optional[int]]]
+    ):
         query = """
             UPDATE pdf
             SET title = ?,
             score = ?
             WHERE url = ?
+            OR id IN (SELECT pdf_id FROM pdf_alias WHERE url = ?)
         """
 
-        await self.db.execute(query, (title, score, url))
+        await self.writer.write(
+            query,
+            [(title, score, url, url) for url, title, score in entries],
+            many=True,
+        )
 
     async def upsert_pdfs(self, pdfs: list[PDF]):
         log.info("Upserting pdfs")
@@ -249,8 +500,7 @@ class PDFGateway(StorageGateway):
             for pdf in pdfs
         ]
 
-        await self.db.executemany(query, rows)
-        await self.db.commit()
+        await self.writer.write(query, rows, many=True)
 
     async def get_processing_status(self, ids: list[str]) -> list[tuple[bool, bool]]:
         query = f"""
@@ -0,0 +1,51 @@
+from asyncio import get_running_loop
+from datetime import datetime
+from zlib import compress, decompress
+from .data_gateway import StorageGateway
+from ..log import log
+
+
+def compress_texts(texts: dict[str, str]) -> list[tuple[str, bytes]]:
+    return [(key, compress(text.encode("utf-8"))) for key, text in texts.items()]
+
+
+def decompress_texts(rows: list[tuple[str, bytes]]) -> dict[str, str]:
+    return {key: decompress(blob).decode("utf-8") for key, blob in rows}
+
+
+class TextGateway(StorageGateway):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS pdf_text (
+            key TEXT PRIMARY KEY,
+            text BLOB NOT NULL,
+            created DATETIME NOT NULL
+        );
+    """
+
+    async def get_texts(self, keys: list[str]) -> dict[str, str]:
+        if not keys:
+            return {}
+
+        placeholders = ",".join(["?" for _ in keys])
+        query = f"SELECT key, text FROM pdf_text WHERE key IN ({placeholders})"
+
+        async with self.db.execute(query, keys) as cursor:
+            rows = await cursor.fetchall()
+
+        return await get_running_loop().run_in_executor(None, decompress_texts, rows)
+
+    async def save_texts(self, texts: dict[str, str]):
+        if not texts:
+            return
+
+        query = """
+            INSERT OR REPLACE INTO pdf_text
+            (key, text, created)
+            VALUES
+            (?, ?, ?)
+        """
+        now = datetime.now()
+        rows = await get_running_loop().run_in_executor(None, compress_texts, texts)
+
+        log.info(f"Storing extracted text for {len(rows)} PDFs")
+        self.writer.submit(query, [(key, blob, now) for key, blob in rows], many=True)
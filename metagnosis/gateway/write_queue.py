@@ -0,0 +1,140 @@
+from asyncio import (
+    Event,
+    Future,
+    Lock,
+    Task,
+    TimeoutError,
+    get_running_loop,
+    shield,
+    wait_for,
+)
+from typing import Any, Optional
+from aiosqlite import Connection
+from ..log import log
+
+Statement = tuple[str, Any, bool]
+
+
+class WriteQueue:
+    db: Connection
+    process_lock: Lock
+    window: float
+    max_size: int
+    pending: list[tuple[list[Statement], Future]]
+    ready: Event
+    draining: bool
+    task: Optional[Task]
+
+    def __init__(
+        self, db: Connection, process_lock: Lock, window: float, max_size: int
+    ):
+        self.db = db
+        self.process_lock = process_lock
+        self.window = window
+        self.max_size = max_size
+        self.pending = []
+        self.ready = Event()
+        self.draining = False
+        self.task = None
+
+    def submit(self, query: str, params: Any = (), many: bool = False) -> Future:
+        return self.submit_all([(query, params, many)])
+
+    def submit_all(self, statements: list[Statement]) -> Future:
+        # The statements commit or fail together
+        loop = get_running_loop()
+        future = loop.create_future()
+
+        self.pending.append((statements, future))
+
+        if self.task is None or self.task.done():
+            self.task = loop.create_task(self.run())
+
+        if len(self.pending) >= self.max_size:
+            self.ready.set()
+
+        return future
+
+    async def write(
+        self, query: str, params: Any = (), many: bool = False, wait: bool = True
+    ):
+        await self.write_all([(query, params, many)], wait)
+
+    async def write_all(self, statements: list[Statement], wait: bool = True):
+        future = self.submit_all(statements)
+
+        # Commits take process_lock, so code that may run inside a transaction
+        # (text, embedding and metadata stores) must use wait=False or submit()
+        if wait:
+            await future
+
+    async def flush(self):
+        # Must not be awaited while holding process_lock
+        self.draining = True
+        self.ready.set()
+
+        try:
+            # The task only ends once the batch being committed and everything
+            # queued behind it have landed
+            while self.task is not None and not self.task.done():
+                await shield(self.task)
+        finally:
+            self.draining = False
+
+    async def run(self):
+        while self.pending:
+            if not self.draining:
+                try:
+                    await wait_for(self.ready.wait(), self.window)
+                except TimeoutError:
+                    pass
+
+            self.ready.clear()
+            batch, self.pending = self.pending, []
+
+            await self.commit(batch)
+
+    async def commit(self, batch: list[tuple[list[Statement], Future]]):
+        failed = {}
+
+        async with self.process_lock:
+            try:
+                # Outside a transaction RELEASE would commit every savepoint on
+                # its own, BEGIN keeps the batch to a single commit
+                if not self.db.in_transaction:
+                    await self.db.execute("BEGIN")
+
+                for i, (statements, _) in enumerate(batch):
+                    # Each write gets its own savepoint so a bad statement only
+                    # fails its own caller
+                    await self.db.execute("SAVEPOINT queued_write")
+
+                    try:
+                        for query, params, many in statements:
+                            if many:
+                                await self.db.executemany(query, params)
+                            else:
+                                await self.db.execute(query, params)
+                    except Exception as e:
+                        await self.db.execute("ROLLBACK TO queued_write")
+                        failed[i] = e
+
+                    await self.db.execute("RELEASE queued_write")
+
+                await self.db.commit()
+            except Exception as e:
+                log.info(f"Failed to commit {len(batch)} queued writes")
+                log.exception(e)
+                await self.db.rollback()
+                failed = {i: e for i in range(len(batch))}
+
+        if failed:
+            log.info(f"{len(failed)} of {len(batch)} queued writes failed")
+
+        for i, (_, future) in enumerate(batch):
+            if i in failed:
+                future.set_exception(failed[i])
+                # Fire-and-forget writers never await their future
+                future.exception()
+            else:
+                future.set_result(None)
@@ -1,12 +1,15 @@
-from asyncio import gather, Semaphore
-from aiohttp import ClientSession
-from aiohttp.client_exceptions import ServerDisconnectedError
+from asyncio import gather, get_running_loop, Semaphore
+from hashlib import sha256
+from aiohttp import ClientResponse
 from feedparser import parse
 from .base import Job
 from ..config import get_config, Config
 from ..log import log
 from ..gateway.encoder import EncoderGateway
+from ..gateway.feed import FeedGateway
+from ..gateway.http import HTTPGateway
 from ..gateway.pdf import PDFGateway
+from ..models.feed import Feed
 
 URL_TEMPLATE = "https://rss.arxiv.org/rss/{}"
 TOPICS = [
@@ -41,12 +44,16 @@ TOPICS = [
 class ArxivProcessorJob(Job):
     INTERVAL = 180
     pdf: PDFGateway
+    feed: FeedGateway
+    http: HTTPGateway
     download_limit: int = 10
     config: Config
 
-    def __init__(self, pdf: PDFGateway):
+    def __init__(self, pdf: PDFGateway, feed: FeedGateway, http: HTTPGateway):
         self.config = get_config()
         self.pdf = pdf
+        self.feed = feed
+        self.http = http
 
     async def perform(self):
         await gather(*(self.process_rss(t) for t in TOPICS))
@@ -59,35 +66,76 @@ class ArxivProcessorJob(Job):
 
     async def _process_rss(self, topic: str):
         url = URL_TEMPLATE.format(topic)
+        feed = await self.feed.get_feed(url) or Feed(url=url)
 
         headers = {"User-Agent": self.config.user_agent}
 
-        for _ in range(self.config.fetch_retries):
-            try:
-                async with ClientSession() as client:
-                    async with client.get(
-                        url, headers=headers, proxy=self.config.proxy
-                    ) as resp:
-                        text = await resp.text()
+        if feed.etag:
+            headers["If-None-Match"] = feed.etag
 
-                break
-            except ServerDisconnectedError:
-                pass
+        if feed.last_modified:
+            headers["If-Modified-Since"] = feed.last_modified
 
-        urls = await self.extract_pdf_urls(text)
+        async def read(resp: ClientResponse):
+            resp.raise_for_status()
+
+            if resp.status == 304:
+                return None
+
+            text = await resp.text()
+
+            return text, resp.headers.get("ETag"), resp.headers.get("Last-Modified")
+
+        result = await self.http.fetch(
+            "GET", url, read, headers=headers, proxy=self.config.proxy
+        )
+
+        if result is None:
+            log.info(f"Feed {topic} not modified")
+            return
+
+        text, etag, last_modified = result
+        digest = sha256(text.encode("utf-8")).hexdigest()
+
+        if digest == feed.digest:
+            log.info(f"Feed {topic} unchanged")
+            return
+
+        loop = get_running_loop()
+        entries = await loop.run_in_executor(None, self.extract_pdf_urls, text)
+        urls = [u for id, u in entries.items() if id not in feed.entries]
         sem = Semaphore(self.download_limit)
 
-        await gather(*(self.pdf.download_pdf(url, "arxiv", sem) for url in urls))
+        log.info(f"Feed {topic} has {len(urls)} new entries")
+        downloaded = await self.pdf.download_pdfs(
+            [(url, None, None) for url in urls], "arxiv", sem
+        )
+
+        if downloaded:
+            self.wake("DocumentProcessorJob")
+
+        # Failed downloads stay unseen and the feed is fetched in full again
+        failed = await self.pdf.filter_new_urls(urls)
+        feed.entries = {id for id, u in entries.items() if u not in failed}
+
+        if failed:
+            log.info(f"Feed {topic} has {len(failed)} entries to retry")
+        else:
+            feed.etag = etag
+            feed.last_modified = last_modified
+            feed.digest = digest
+
+        await self.feed.save_feed(feed)
 
-    async def extract_pdf_urls(self, text: str) -> list[str]:
+    def extract_pdf_urls(self, text: str) -> dict[str, str]:
         feed = parse(text)
-        urls: list[str] = []
+        urls: dict[str, str] = {}
 
         for entry in feed.entries:
             url = entry.link
 
             if url:
                 pdf_url = url.replace("/abs/", "/pdf/")
-                urls.append(pdf_url)
+                urls[entry.get("id", url)] = pdf_url
 
         return urls
@@ -1,11 +1,15 @@
 from abc import ABC, abstractmethod
 from datetime import datetime
+from typing import Callable, Optional
 
 
 class Job(ABC):
     INTERVAL = 60
+    # Falls back to Config.job_timeout
+    TIMEOUT: Optional[float] = None
     current: datetime
     last: datetime
+    waker: Optional[Callable[[str], None]] = None
 
     @abstractmethod
     async def perform(self):
@@ -14,3 +18,9 @@ class Job(ABC):
     def set_run_times(self, last: datetime, current: datetime):
         self.last_run_time = last
         self.current_run_time = current
+
+    def wake(self, name: str):
+        # Only reaches jobs on this process's JobServer, a DocumentProcessorJob
+        # in metagnosis.worker picks new PDFs up on its own interval
+        if self.waker is not None:
+            self.waker(name)
@@ -1,51 +1,150 @@
-from asyncio import as_completed, gather, get_running_loop
-from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from asyncio import (
+    CancelledError,
+    Queue,
+    TaskGroup,
+    get_running_loop,
+    sleep,
+)
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
 from multiprocessing import cpu_count
-from os import remove
-from typing import List, Tuple
+from os import getpid
+from socket import gethostname
+from uuid import uuid4
+from typing import List
 from .base import Job
+from ..config import get_config, Config
 from ..gateway.encoder import EncoderGateway
 from ..gateway.document import DocumentGateway
+from ..gateway.extractor import ExtractionGateway
 from ..gateway.pdf import PDFGateway
 from ..log import log
 from ..models.document import Document
-from ..models.task import Task, TaskCategory
+from ..models.pdf import PDF
+from ..util.pipeline import run_stage
 
 
 class DocumentProcessorJob(Job):
     INTERVAL = 1
     document: DocumentGateway
     encoder: EncoderGateway
-    text_executor: ThreadPoolExecutor
+    extractor: ExtractionGateway
     pdf: PDFGateway
     limit: int
+    worker: str
+    claimed: set[str]
+    config: Config
 
     def __init__(
         self,
         document: DocumentGateway,
         pdf: PDFGateway,
         encoder: EncoderGateway,
+        extractor: ExtractionGateway,
     ):
+        self.config = get_config()
         self.limit = cpu_count() * 2
+        self.worker = f"{gethostname()}:{getpid()}:{uuid4().hex[:8]}"
+        self.claimed = set()
         self.document = document
         self.encoder = encoder
-        self.text_executor = ThreadPoolExecutor(max_workers=self.limit)
+        self.extractor = extractor
         self.pdf = pdf
 
     async def perform(self):
-        async with self.pdf.get_pdfs_for_processing(limit=self.limit) as pdfs:
-            loop = get_running_loop()
-
-            await gather(
-                *[
-                    loop.run_in_executor(self.text_executor, p.hydrate_text)
-                    for p in pdfs
-                ]
-            )
+        # Bounded queues let extraction of the next batch overlap encoding of
+        # this one without claiming more than the stages can take
+        size = self.config.pipeline_queue_size
+        claimed, extracted, encoded = Queue(size), Queue(size), Queue(size)
+        renewal = get_running_loop().create_task(self.renew_leases())
+
+        # Failed batches keep their claim until it expires, which spaces out retries
+        try:
+            async with TaskGroup() as group:
+                group.create_task(self.claim(claimed))
+                group.create_task(
+                    run_stage(
+                        "extract",
+                        self.extract,
+                        claimed,
+                        extracted,
+                        self.config.pipeline_extract_workers,
+                        lambda pdfs: self.unclaim([p.id for p in pdfs]),
+                    )
+                )
+                group.create_task(
+                    run_stage(
+                        "encode",
+                        self.encode,
+                        extracted,
+                        encoded,
+                        self.config.pipeline_encode_workers,
+                        lambda pdfs: self.unclaim([p.id for p in pdfs]),
+                    )
+                )
+                group.create_task(
+                    run_stage(
+                        "save",
+                        self.save,
+                        encoded,
+                        None,
+                        1,
+                        lambda documents: self.unclaim(list(documents)),
+                    )
+                )
+        except CancelledError:
+            if self.claimed:
+                self.pdf.release_pdfs(self.worker, list(self.claimed))
+
+            raise
+        finally:
+            renewal.cancel()
+            self.claimed.clear()
+
+    async def claim(self, queue: Queue):
+        while 1:
+            pdfs = await self.pdf.claim_pdfs(self.worker, self.limit)
+
+            if not pdfs:
+                break
+
+            self.claimed.update(p.id for p in pdfs)
+            await queue.put(pdfs)
+
+        await queue.put(None)
 
-            await self.process_documents({p.id: Document.from_pdf(p) for p in pdfs})
+    async def renew_leases(self):
+        while 1:
+            await sleep(self.config.pdf_lease / 3)
 
-    async def process_documents(self, documents: dict[str, Document]):
+            if self.claimed:
+                self.pdf.renew_leases(self.worker, list(self.claimed))
+
+    def unclaim(self, ids: list[str]):
+        # Stop renewing, the leases expire and the batch is retried later
+        self.claimed.difference_update(ids)
+
+    async def extract(self, pdfs: List[PDF]) -> List[PDF]:
+        _, errors = await self.extractor.hydrate(pdfs)
+        # A crashed pool takes down every file in flight, so only retry those
+        failed = {
+            id: repr(e)
+            for id, e in errors.items()
+            if not isinstance(e, BrokenProcessPool)
+        }
+
+        if failed:
+            log.info(f"Marking {len(failed)} unreadable PDFs as failed")
+            await self.pdf.fail_pdfs(self.worker, failed)
+
+        self.unclaim(list(errors))
+
+        return [p for p in pdfs if p.id not in errors]
+
+    async def encode(self, pdfs: List[PDF]) -> dict[str, Document]:
+        documents = {p.id: Document.from_pdf(p) for p in pdfs}
         encodings = await self.encoder.encode(
             [(d.id, d.text) for d in documents.values()]
         )
@@ -53,4 +152,68 @@ class DocumentProcessorJob(Job):
         for id, vector in encodings:
             documents[id].vector = vector
 
-        await self.document.save_documents([d for d in documents.values()])
+        return documents
+
+    async def save(self, documents: dict[str, Document]):
+        # Reads only, so it stays outside the lock
+        duplicates = await self.find_duplicates(list(documents.values()))
+
+        async with self.pdf.transaction():
+            if duplicates:
+                log.info(f"Skipping {len(duplicates)} near-duplicate documents")
+                await self.pdf.mark_duplicates(duplicates)
+
+            await self.document.save_documents(
+                [d for d in documents.values() if d.id not in duplicates], commit=False
+            )
+            await self.pdf.complete_pdfs(self.worker, list(documents))
+
+        self.claimed.difference_update(documents)
+
+    async def find_duplicates(self, documents: list[Document]) -> dict[str, str]:
+        if not documents:
+            return {}
+
+        max_distance = 1 - self.config.duplicate_threshold
+        since = datetime.now() - timedelta(seconds=self.config.duplicate_window)
+        vectors = np.array([d.vector for d in documents], dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        similarity = vectors @ vectors.T
+        duplicates = {}
+        kept = []
+
+        # Unfiltered KNN uses the vector index, the window is applied afterwards
+        # to the few close candidates instead of scanning it per document
+        neighbours = [
+            [
+                (id, distance)
+                for id, distance in await self.document.find_similar(
+                    doc.vector, self.config.duplicate_candidates
+                )
+                if id != doc.id and distance <= max_distance
+            ]
+            for doc in documents
+        ]
+        created = await self.document.get_created(
+            list({id for similar in neighbours for id, _ in similar})
+        )
+
+        for i, doc in enumerate(documents):
+            similar = [
+                s for s in neighbours[i] if s[0] in created and created[s[0]] >= since
+            ]
+
+            if similar:
+                duplicates[doc.id] = similar[0][0]
+                continue
+
+            match = next(
+                (j for j in kept if 1 - similarity[i, j] <= max_distance), None
+            )
+
+            if match is not None:
+                duplicates[doc.id] = documents[match].id
+            else:
+                kept.append(i)
+
+        return duplicates
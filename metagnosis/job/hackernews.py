@@ -2,41 +2,51 @@ from asyncio import gather, wait_for, CancelledError, TimeoutError
 from datetime import datetime
 from hashlib import sha256
 from os.path import join
-from aiohttp import ClientSession
-from bs4 import BeautifulSoup
-from playwright.async_api import async_playwright, Browser
-from playwright._impl._errors import TargetClosedError
-from trafilatura import extract
+from typing import TYPE_CHECKING
 from .base import Job
 from ..config import get_config, Config
+from ..gateway.http import HTTPGateway
 from ..gateway.pdf import PDFGateway
 from ..log import log
 from ..models.pdf import PDF
 
+if TYPE_CHECKING:
+    from playwright.async_api import Browser
+
 
 class HackerNewsProcessorJob(Job):
     INTERVAL = 60
+    TIMEOUT = 900
     REQUEST_TIMEOUT = 120
     storage_path: str
     user_agent: str
     pdf: PDFGateway
+    http: HTTPGateway
     config: Config
 
-    def __init__(self, storage_path: str, user_agent: str, pdf: PDFGateway):
+    def __init__(
+        self, storage_path: str, user_agent: str, pdf: PDFGateway, http: HTTPGateway
+    ):
         self.storage_path = storage_path
         self.pdf = pdf
+        self.http = http
         self.user_agent = user_agent
         self.hn_url = "https://news.ycombinator.com/"
         self.config = get_config()
 
     async def perform(self):
+        from bs4 import BeautifulSoup
+        from playwright.async_api import async_playwright
+
         headers = {"User-Agent": self.config.user_agent}
 
-        async with ClientSession() as session:
-            async with session.get(
-                self.hn_url, headers=headers, proxy=self.config.proxy
-            ) as resp:
-                html = await resp.text()
+        html = await self.http.fetch(
+            "GET",
+            self.hn_url,
+            lambda resp: resp.text(),
+            headers=headers,
+            proxy=self.config.proxy,
+        )
 
         soup = BeautifulSoup(html, "html.parser")
         titles = [i.find("a").text for i in soup.find_all("span", class_="titleline")]
@@ -57,21 +67,35 @@ class HackerNewsProcessorJob(Job):
             raise ValueError("Elements found are not equal")
 
         unprepared = await self.pdf.get_processing_status(ids)
+        entities = [
+            (id, title, url, comment, needs_update)
+            for id, title, url, comment, (needs_update, processed) in zip(
+                ids, titles, urls, comments, unprepared
+            )
+            if not processed
+        ]
+        pdfs = [(e[2], e[1], e[3]) for e in entities if e[2].endswith(".pdf")]
 
         async with async_playwright() as p:
             browser = await p.chromium.launch()
-            pages = await gather(
-                *(
-                    self.process_entity(browser, id, title, url, comment, needs_update)
-                    for id, title, url, comment, (needs_update, processed) in zip(
-                        ids, titles, urls, comments, unprepared
+            pages, downloaded = await gather(
+                gather(
+                    *(
+                        self.process_entity(browser, *e)
+                        for e in entities
+                        if not e[2].endswith(".pdf")
                     )
-                    if not processed
-                )
+                ),
+                self.pdf.download_pdfs(pdfs, "Hacker News"),
             )
 
         log.info("Pages gathered, upserting")
-        await self.pdf.upsert_pdfs([i for i in pages if i])
+        pages = [i for i in pages if i]
+
+        await self.pdf.upsert_pdfs(pages)
+
+        if pages or downloaded:
+            self.wake("DocumentProcessorJob")
 
     async def process_entity(self, *args) -> PDF:
         try:
@@ -83,23 +107,20 @@ class HackerNewsProcessorJob(Job):
 
     async def _process_entity(
         self,
-        browser: Browser,
+        browser: "Browser",
         id: str,
         title: str,
         url: str,
         comment: int,
         needs_update: bool,
     ) -> PDF:
+        from playwright._impl._errors import TargetClosedError
+
         if url.startswith("item?id="):
             url = "https://news.ycombinator.com/" + url
 
         log.info(f"Processing entity {url}")
 
-        if url.endswith(".pdf"):
-            await self.pdf.download_pdf(url, "Hacker News", title=title, score=comment)
-
-            return
-
         if needs_update:
             return self.update_page(id, title, url, comment)
 
@@ -126,7 +147,7 @@ class HackerNewsProcessorJob(Job):
         )
 
     async def new_page(
-        self, browser: Browser, id: str, title: str, url: str, comment: int
+        self, browser: "Browser", id: str, title: str, url: str, comment: int
     ) -> PDF:
         log.info(f"Fetching page {url}")
 
@@ -162,6 +183,8 @@ class HackerNewsProcessorJob(Job):
         )
 
     async def screenshot_page(self, page, id) -> str:
+        from trafilatura import extract
+
         log.info(f"Screenshotting page {id}")
 
         path = join(self.storage_path, id)
@@ -0,0 +1,30 @@
+from .base import Job
+from ..config import get_config, Config
+from ..gateway.llm import LLMGateway
+from ..gateway.text import TextGateway
+from ..log import log
+
+
+class MetadataJob(Job):
+    INTERVAL = 300
+    llm: LLMGateway
+    text: TextGateway
+    config: Config
+
+    def __init__(self, llm: LLMGateway, text: TextGateway):
+        self.config = get_config()
+        self.llm = llm
+        self.text = text
+
+    async def perform(self):
+        missing = await self.llm.get_missing(self.config.metadata_batch)
+
+        if not missing:
+            return
+
+        texts = await self.text.get_texts(list({key for _, key in missing}))
+        metadata = await self.llm.extract_metadata_many(
+            [(id, texts[key]) for id, key in missing if key in texts]
+        )
+
+        log.info(f"Extracted metadata for {sum(1 for m in metadata if m)} documents")
@@ -0,0 +1,30 @@
+from typing import Optional
+from .base import Job
+from ..gateway.metrics import MetricsGateway
+from ..gateway.pdf import PDFGateway
+from ..util.metrics import pdf_queue, registry
+
+
+class MetricsJob(Job):
+    INTERVAL = 60
+    metrics: MetricsGateway
+    pdf: PDFGateway
+    worker: Optional[str]
+
+    def __init__(
+        self, metrics: MetricsGateway, pdf: PDFGateway, worker: Optional[str] = None
+    ):
+        self.metrics = metrics
+        self.pdf = pdf
+        self.worker = worker
+
+    async def perform(self):
+        samples = registry.snapshot()
+
+        if self.worker is None:
+            pdf_queue.set(await self.pdf.count_unprocessed())
+        else:
+            # Keeps each worker's counters apart from the main process
+            samples = ((n, {**l, "worker": self.worker}, v) for n, l, v in samples)
+
+        await self.metrics.save_snapshot(list(samples))
@@ -6,29 +6,25 @@ from json import dumps
 from os import remove
 from pathlib import Path
 from tempfile import NamedTemporaryFile
-from typing import Any, Optional
+from typing import Any, Optional, TYPE_CHECKING
 from uuid import uuid4
 
 import numpy as np
 
-from aioboto3 import Session
-from aiohttp import ClientResponseError, ClientSession
-from fpdf import FPDF
-from pikepdf import open as pikepdf_open
-from PIL import Image
-from PyPDF2 import PdfMerger, PdfReader, PdfWriter
-from PyPDF2.generic import RectangleObject
+from aiohttp import ClientResponseError
 from pydantic import BaseModel, ConfigDict
-from sklearn.cluster import KMeans
-from scipy.spatial.distance import cdist
 from .base import Job
 from .arxiv import TOPICS
 from ..config import get_config, Config, PublishCredentials
 from ..gateway.document import DocumentGateway
-from ..gateway.image_gen import ImageGenerationGateway
+from ..gateway.http import HTTPGateway
 from ..log import log
+from ..util.metrics import publisher_stage
 from ..models.document import Document
 
+if TYPE_CHECKING:
+    from ..gateway.image_gen import ImageGenerationGateway
+
 LULU_TEST = "https://api.sandbox.lulu.com"
 LULU_PROD = "https://api.lulu.com"
 
@@ -36,7 +32,7 @@ LULU_PROD = "https://api.lulu.com"
 class ArxivClusters(BaseModel):
     ids: list[str]
     vectors: Any
-    kmeans: KMeans
+    kmeans: Any
     clusters: int
     model_config = ConfigDict(arbitrary_types_allowed=True)
 
@@ -45,20 +41,22 @@ class PublisherJob(Job):
     INTERVAL = 604800
     API_PREFIX = LULU_PROD
     document: DocumentGateway
+    http: HTTPGateway
     hn_limit: int = 25
     arxiv_limit: int = 25
     hn_rank_threshold: int = 100
-    image: ImageGenerationGateway
+    _image: Optional["ImageGenerationGateway"]
     aws_access_key_id: str
     aws_secret_access_key: str
     s3_bucket: str
     publish_creds: PublishCredentials
     proxy: Optional[str]
 
-    def __init__(self, document: DocumentGateway):
+    def __init__(self, document: DocumentGateway, http: HTTPGateway):
         config = get_config()
         self.document = document
-        self.image = ImageGenerationGateway()
+        self.http = http
+        self._image = None
         self.aws_access_key_id = config.aws_access_key_id
         self.aws_secret_access_key = config.aws_secret_access_key
         self.s3_bucket = config.s3_bucket
@@ -66,6 +64,15 @@ class PublisherJob(Job):
         self.lulu_auth = config.lulu_auth
         self.proxy = config.proxy
 
+    @property
+    def image(self) -> "ImageGenerationGateway":
+        if self._image is None:
+            from ..gateway.image_gen import ImageGenerationGateway
+
+            self._image = ImageGenerationGateway()
+
+        return self._image
+
     async def perform(self):
         args_multi = [
             # ("Hacker News", self.last_run_time, self.hn_rank_threshold, self.hn_limit),
@@ -75,20 +82,27 @@ class PublisherJob(Job):
         async with self.document.get_documents_for_processing_multi(
             args_multi
         ) as docs_multi:
-            docs = self.get_relevant_docs(docs_multi)
+            with publisher_stage.time(stage="select"):
+                docs = self.get_relevant_docs(docs_multi)
 
             if not docs:
                 return
 
             start, end = self.get_times(docs_multi)
-            cover_page_path = await self.get_cover_page(start, end)
-            body_file_path = await self.merge_pdfs(docs)
+
+            with publisher_stage.time(stage="cover"):
+                cover_page_path = await self.get_cover_page(start, end)
+
+            with publisher_stage.time(stage="merge"):
+                body_file_path = await self.merge_pdfs(docs)
 
             try:
-                cover_path = await self.upload_to_s3(cover_page_path)
-                body_path = await self.upload_to_s3(body_file_path)
+                with publisher_stage.time(stage="upload"):
+                    cover_path = await self.upload_to_s3(cover_page_path)
+                    body_path = await self.upload_to_s3(body_file_path)
 
-                await self.publish_book(cover_path, body_path)
+                with publisher_stage.time(stage="publish"):
+                    await self.publish_book(cover_path, body_path)
             finally:
                 remove(cover_page_path)
                 remove(body_file_path)
@@ -101,12 +115,11 @@ class PublisherJob(Job):
         }
         data = {"grant_type": "client_credentials"}
 
-        async with ClientSession() as session:
-            async with session.post(
-                url, proxy=self.proxy, headers=headers, data=data
-            ) as response:
-                payload = await response.json()
-                return payload["access_token"]
+        async with self.http.session.post(
+            url, proxy=self.proxy, headers=headers, data=data
+        ) as response:
+            payload = await response.json()
+            return payload["access_token"]
 
     async def publish_book(self, cover_path: str, body_path: str) -> str:
         auth = await self.get_lulu_auth()
@@ -146,20 +159,19 @@ class PublisherJob(Job):
             "shipping_level": self.publish_creds.shipping_level,
         }
 
-        async with ClientSession() as session:
-            async with session.post(
-                url, headers=headers, data=dumps(payload)
-            ) as response:
-                try:
-                    response.raise_for_status()
-                except ClientResponseError as e:
-                    error_response = await response.text()
+        async with self.http.session.post(
+            url, headers=headers, data=dumps(payload)
+        ) as response:
+            try:
+                response.raise_for_status()
+            except ClientResponseError as e:
+                error_response = await response.text()
 
-                    raise RuntimeError(
-                        f"Lulu Error: {e.status}, Details: {error_response}"
-                    )
+                raise RuntimeError(f"Lulu Error: {e.status}, Details: {error_response}")
 
     async def upload_to_s3(self, file_name: str):
+        from aioboto3 import Session
+
         object_name = Path(file_name).name
         session = Session(
             aws_access_key_id=self.aws_access_key_id,
@@ -178,6 +190,9 @@ class PublisherJob(Job):
         return presigned_url
 
     async def merge_pdfs(self, docs: list[Document]) -> NamedTemporaryFile:
+        from PyPDF2 import PdfMerger, PdfReader, PdfWriter
+        from PyPDF2.generic import RectangleObject
+
         temp_file = NamedTemporaryFile(delete=True, suffix=".pdf")
 
         try:
@@ -214,6 +229,8 @@ class PublisherJob(Job):
             remove(temp_file.name)
 
     async def fix_pdf(self, path: str) -> str:
+        from pikepdf import open as pikepdf_open
+
         try:
             output_path = NamedTemporaryFile(suffix=".pdf").name
 
@@ -261,6 +278,9 @@ class PublisherJob(Job):
         return output_path
 
     async def get_cover_page(self, start: datetime, end: datetime) -> str:
+        from fpdf import FPDF
+        from PIL import Image
+
         image_path = self.image.generate_random_image()
 
         try:
@@ -350,6 +370,8 @@ class PublisherJob(Job):
         return [d for d in docs if d.id in ids]
 
     def get_arxiv_cluster(self, docs: list[Document]) -> ArxivClusters:
+        from sklearn.cluster import KMeans
+
         data = {d.id: d.vector for d in docs}
         ids = list(data.keys())
         vectors = np.array(list(data.values()))
@@ -1,55 +1,106 @@
-from asyncio import gather, new_event_loop, Lock
-from os import _exit
-from signal import signal, SIGTERM, SIGINT
+from time import perf_counter
+
+started = perf_counter()
+
+from asyncio import gather, Lock
 from time import sleep
 
 from aiosqlite import connect
-from sqlite_vec import loadable_path
 
 from .config import get_config
+from .gateway.data_gateway import open_database
 from .gateway.document import DocumentGateway
+from .gateway.embedding_cache import EmbeddingCacheGateway
 from .gateway.encoder import EncoderGateway
+from .gateway.extractor import ExtractionGateway
+from .gateway.feed import FeedGateway
+from .gateway.http import HTTPGateway
+from .gateway.llm import LLMGateway
+from .gateway.metadata import MetadataGateway
+from .gateway.metrics import MetricsGateway
 from .gateway.pdf import PDFGateway
+from .gateway.text import TextGateway
+from .gateway.write_queue import WriteQueue
 from .job.arxiv import ArxivProcessorJob
 from .job.hackernews import HackerNewsProcessorJob
 from .job.doc_processor import DocumentProcessorJob
+from .job.metadata import MetadataJob
+from .job.metrics import MetricsJob
 from .job.publisher import PublisherJob
 from .util.job_server import JobServer
+from .util.metrics import serve_metrics
+from .util.runner import run
+from .util.timing import timed
+from .log import log
 
 
 async def main():
-    config = get_config()
-    conn = await connect(config.db_path)
-    job_conn = await connect(config.job_path)
-    process_lock = Lock()
+    log.info(f"Startup: imports took {perf_counter() - started:.2f}s")
 
-    await conn.enable_load_extension(True)
-    await conn.load_extension(loadable_path())
-    await conn.enable_load_extension(False)
-    await conn.execute("PRAGMA journal_mode=WAL;")
+    with timed("Startup: config"):
+        config = get_config()
 
-    document = await DocumentGateway.new(conn, config.storage_path, process_lock)
-    pdf = await PDFGateway.new(conn, config.storage_path, process_lock)
-    encoder = EncoderGateway()
-    jobs = [
-        # ArxivProcessorJob(pdf),
-        # HackerNewsProcessorJob(config.storage_path, config.user_agent, pdf),
-        # DocumentProcessorJob(document, pdf, encoder),
-        PublisherJob(document),
-    ]
+    with timed("Startup: database"):
+        conn = await open_database(config.db_path)
+        job_conn = await connect(config.job_path)
+        process_lock = Lock()
 
-    server = JobServer(job_conn, jobs)
+    # Heavy dependencies and models load when a job first needs them
+    with timed("Startup: gateways"):
+        writer = WriteQueue(conn, process_lock, config.write_window, config.write_batch)
+        http = HTTPGateway()
+        document = await DocumentGateway.new(
+            conn, config.storage_path, process_lock, writer
+        )
+        pdf = await PDFGateway.new(
+            conn, config.storage_path, process_lock, writer, http
+        )
+        text = await TextGateway.new(conn, config.storage_path, process_lock, writer)
+        cache = await EmbeddingCacheGateway.new(
+            conn, config.storage_path, process_lock, writer
+        )
+        metrics = await MetricsGateway.new(
+            conn, config.storage_path, process_lock, writer
+        )
+        metadata = await MetadataGateway.new(
+            conn, config.storage_path, process_lock, writer
+        )
+        encoder = EncoderGateway(cache)
+        extractor = ExtractionGateway(text)
+        llm = LLMGateway(metadata)
 
-    await server.start()
+    with timed("Startup: jobs"):
+        jobs = [
+            # Build a FeedGateway here when re-enabling the arxiv job
+            # ArxivProcessorJob(pdf, feed, http),
+            # HackerNewsProcessorJob(config.storage_path, config.user_agent, pdf, http),
+            # DocumentProcessorJob(document, pdf, encoder, extractor),
+            # MetadataJob(llm, text),
+            PublisherJob(document, http),
+            MetricsJob(metrics, pdf),
+        ]
 
+        server = JobServer(job_conn, jobs)
 
-def signal_handler(signum, frame):
-    _exit(1)
+    if config.metrics_port:
+        metrics_server = await serve_metrics(config.metrics_host, config.metrics_port)
+    else:
+        metrics_server = None
 
+    log.info(f"Startup: total {perf_counter() - started:.2f}s")
 
-if __name__ == "__main__":
-    signal(SIGTERM, signal_handler)
-    signal(SIGINT, signal_handler)
+    try:
+        await server.start()
+    finally:
+        if metrics_server is not None:
+            await metrics_server.cleanup()
 
-    loop = new_event_loop()
-    loop.run_until_complete(main())
+        await writer.flush()
+        await http.close()
+        extractor.close(wait=False)
+        llm.close()
+        await encoder.close()
+
+
+if __name__ == "__main__":
+    run(main)
@@ -0,0 +1,12 @@
+from datetime import datetime
+from typing import Optional, Set
+from pydantic import BaseModel
+
+
+class Feed(BaseModel):
+    url: str
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    digest: Optional[str] = None
+    entries: Set[str] = set()
+    updated: Optional[datetime] = None
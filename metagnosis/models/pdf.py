@@ -1,7 +1,6 @@
 from datetime import datetime
 from typing import Optional
 from pydantic import BaseModel
-from pymupdf import open as open_pdf
 
 
 class PDF(BaseModel):
@@ -16,13 +15,4 @@ class PDF(BaseModel):
     updated: datetime
     processed: bool
     text: Optional[str] = None
-
-    def hydrate_text(self):
-        text = ""
-
-        with open_pdf(self.path) as f:
-            for page_num in range(len(f)):
-                page = f[page_num]
-                text += page.get_text()
-
-        self.text = text
+    hash: Optional[str] = None
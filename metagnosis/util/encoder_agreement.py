@@ -0,0 +1,68 @@
+import numpy as np
+
+from sqlite3 import connect
+from sys import argv
+from time import perf_counter
+from ..config import get_config
+from ..gateway.encoder import EncoderGateway
+from ..gateway.text import decompress_texts
+from ..log import log
+
+
+def sample_texts(db_path: str, count: int) -> list[str]:
+    with connect(db_path) as conn:
+        rows = conn.execute(
+            "SELECT key, text FROM pdf_text ORDER BY random() LIMIT ?", (count,)
+        ).fetchall()
+
+    return list(decompress_texts(rows).values())
+
+
+def encode(backend: str, texts: list[str]) -> tuple[np.ndarray, float]:
+    encoder = EncoderGateway(None, backend)
+    # Load outside the timed section
+    encoder.model
+    start = perf_counter()
+    truncated, lengths = encoder.truncate(texts)
+    vectors = encoder.encode_batches(truncated, lengths)
+    elapsed = perf_counter() - start
+
+    log.info(f"{encoder.cache_key}: {len(texts)} texts in {elapsed:.2f}s")
+
+    return vectors, elapsed
+
+
+def cosine(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    a = a / np.linalg.norm(a, axis=1, keepdims=True)
+    b = b / np.linalg.norm(b, axis=1, keepdims=True)
+
+    return (a * b).sum(axis=1)
+
+
+def main():
+    config = get_config()
+    count = int(argv[1]) if len(argv) > 1 else 64
+    texts = sample_texts(config.db_path, count)
+
+    if not texts:
+        log.error("No extracted text to compare against")
+        return
+
+    reference, reference_time = encode("torch", texts)
+    candidate, candidate_time = encode("onnx", texts)
+    dimension = config.vector_dimension
+
+    for name, scores in (
+        ("full", cosine(reference, candidate)),
+        (str(dimension), cosine(reference[:, :dimension], candidate[:, :dimension])),
+    ):
+        log.info(
+            f"Cosine agreement ({name}): mean {scores.mean():.5f}, "
+            f"p1 {np.percentile(scores, 1):.5f}, min {scores.min():.5f}"
+        )
+
+    log.info(f"Speedup: {reference_time / candidate_time:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,54 @@
-from asyncio import gather, sleep
-from datetime import datetime, timedelta, UTC
+from asyncio import (
+    CancelledError,
+    Event,
+    Semaphore,
+    Task,
+    TimeoutError,
+    create_task,
+    gather,
+    timeout as deadline,
+    wait_for,
+)
+from datetime import datetime, UTC
+from heapq import heappop, heappush
+from itertools import count
 from time import time
+from typing import Optional, Union
 from aiosqlite import Connection
+from ..config import get_config, Config
 from ..job.base import Job
 from ..log import log
+from ..util.metrics import job_duration, job_runs, jobs_running
 
 
 class JobServer:
     db: Connection
+    config: Config
+    # Delay before a failed job is retried
     INTERVAL = 1
+    heap: list[tuple[float, int, str]]
+    schedule: dict[str, float]
+    last_run: dict[str, float]
+    wakeup: Event
+    running: dict[str, Task]
+    deferred: set[str]
+    semaphore: Semaphore
 
     def __init__(self, db: Connection, jobs: list[Job]):
         self.db = db
+        self.config = get_config()
         self.job_map = {j.__class__.__name__: j for j in jobs}
+        self.heap = []
+        self.schedule = {}
+        self.last_run = {}
+        self.counter = count()
+        self.wakeup = Event()
+        self.running = {}
+        self.deferred = set()
+        self.semaphore = Semaphore(self.config.job_concurrency)
+
+        for job in jobs:
+            job.waker = self.wake
 
     async def initialize_job_db(self):
         schema = """
@@ -33,70 +69,167 @@ class JobServer:
 
         await self.db.commit()
 
-        for job in self.job_map.values():
-            await self.update_next_run_time(job)
+        query = "SELECT name, next_run_time, last_run_time FROM job"
 
-    async def update_next_run_time(self, job: Job):
+        async with self.db.execute(query) as cursor:
+            stored = {row[0]: (row[1], row[2]) async for row in cursor}
+
+        now = time()
+
+        for name, job in self.job_map.items():
+            next_run_time, last_run_time = stored.get(name, (now + job.INTERVAL, now))
+            self.last_run[name] = last_run_time
+            self.push(name, next_run_time)
+
+        await self.persist(list(self.job_map))
+
+    def push(self, name: str, when: float):
+        # Superseded heap entries are skipped when popped
+        self.schedule[name] = when
+        heappush(self.heap, (when, next(self.counter), name))
+
+    def reschedule(self, name: str, when: float):
+        # Keep an earlier wake that arrived while the job was running
+        if self.schedule.get(name, when) >= when:
+            self.push(name, when)
+
+    def wake(self, job: Union[Job, str]):
+        name = job if isinstance(job, str) else job.__class__.__name__
+
+        if name not in self.job_map:
+            return
+
+        self.reschedule(name, time())
+        self.wakeup.set()
+
+    def pop_due(self, now: float) -> list[str]:
+        due = []
+
+        while self.heap and self.heap[0][0] <= now:
+            when, _, name = heappop(self.heap)
+
+            if self.schedule.get(name) == when:
+                del self.schedule[name]
+                due.append(name)
+
+        return due
+
+    def next_deadline(self) -> Optional[float]:
+        while self.heap and self.schedule.get(self.heap[0][2]) != self.heap[0][0]:
+            heappop(self.heap)
+
+        return self.heap[0][0] if self.heap else None
+
+    async def persist(self, names: list[str]):
         query = """
-        INSERT INTO job 
+        INSERT INTO job
         (name, next_run_time, last_run_time)
         VALUES (?, ?, ?)
-        ON CONFLICT(name) 
-        DO UPDATE SET next_run_time = excluded.next_run_time
-        WHERE job.next_run_time < excluded.next_run_time;
+        ON CONFLICT(name)
+        DO UPDATE SET
+            next_run_time = excluded.next_run_time,
+            last_run_time = excluded.last_run_time;
         """
+        rows = [
+            (name, int(self.schedule.get(name, time())), int(self.last_run[name]))
+            for name in names
+        ]
 
-        dt = datetime.now() + timedelta(seconds=job.INTERVAL)
-        next_run_time = int(dt.timestamp())
-
-        await self.db.execute(
-            query, (job.__class__.__name__, next_run_time, int(dt.timestamp()))
-        )
+        await self.db.executemany(query, rows)
         await self.db.commit()
 
-    async def get_jobs_to_run(self) -> list[tuple[Job, datetime]]:
-        query = """
-        SELECT
-            name, last_run_time
-        FROM job
-        WHERE next_run_time <= ?
-        """
+    async def start(self):
+        await self.initialize_job_db()
 
-        results = []
-        now = int(time())
+        try:
+            while 1:
+                for name in self.pop_due(time()):
+                    self.dispatch(name)
 
-        async with self.db.execute(query, (now,)) as cursor:
-            async for row in cursor:
-                if row[0] in self.job_map:
-                    results.append((self.job_map[row[0]], row[1]))
+                deadline = self.next_deadline()
+                timeout = None if deadline is None else max(deadline - time(), 0)
+                self.wakeup.clear()
 
-        return results
+                try:
+                    await wait_for(self.wakeup.wait(), timeout)
+                except TimeoutError:
+                    pass
+        finally:
+            await self.stop()
 
-    async def start(self):
-        await self.initialize_job_db()
+    async def stop(self):
+        tasks = list(self.running.values())
 
-        now = datetime.now(UTC)
+        for task in tasks:
+            task.cancel()
 
-        while 1:
-            jobs = await self.get_jobs_to_run()
+        await gather(*tasks, return_exceptions=True)
 
-            await gather(
-                *(
-                    self.execute_job(j[0], now, datetime.fromtimestamp(j[1], UTC))
-                    for j in jobs
-                )
-            )
-            await sleep(self.INTERVAL)
+    def dispatch(self, name: str):
+        # A run that comes due while the job is still going starts once it ends
+        if name in self.running:
+            self.deferred.add(name)
+            return
+
+        task = create_task(self.supervise(self.job_map[name]))
+        task.add_done_callback(lambda _: self.finished(name))
+        self.running[name] = task
+
+    def finished(self, name: str):
+        del self.running[name]
 
-    async def execute_job(self, job: Job, current: datetime, last: datetime):
-        log.info(f"Executing job {job.__class__.__name__}")
+        if name in self.deferred:
+            self.deferred.discard(name)
+            self.reschedule(name, time())
+
+        self.wakeup.set()
+
+    async def supervise(self, job: Job):
+        async with self.semaphore:
+            await self.execute_job(job)
 
         try:
-            job.set_run_times(last, current)
-            await job.perform()
-            await self.update_next_run_time(job)
+            await self.persist([job.__class__.__name__])
         except Exception as e:
-            log.info(f"Failed to execute job {job.__class__.__name__}")
             log.exception(e)
+
+    async def execute_job(self, job: Job):
+        name = job.__class__.__name__
+        timeout = job.TIMEOUT or self.config.job_timeout
+        current = time()
+        status = "success"
+        limit = None
+
+        log.info(f"Executing job {name}")
+        jobs_running.inc(job=name)
+
+        try:
+            job.set_run_times(
+                datetime.fromtimestamp(self.last_run[name], UTC),
+                datetime.fromtimestamp(current, UTC),
+            )
+            async with deadline(timeout) as limit:
+                await job.perform()
+        except CancelledError:
+            log.info(f"Cancelled job {name}")
+            status = "cancelled"
+            raise
+        except Exception as e:
+            # Timeouts raised inside the job itself are ordinary failures
+            if isinstance(e, TimeoutError) and limit is not None and limit.expired():
+                log.info(f"Job {name} timed out after {timeout}s")
+                status = "timeout"
+            else:
+                log.info(f"Failed to execute job {name}")
+                log.exception(e)
+                status = "failure"
+
+            self.reschedule(name, time() + self.INTERVAL)
         else:
-            log.info(f"Finished executing job {job.__class__.__name__}")
+            log.info(f"Finished executing job {name}")
+            self.last_run[name] = current
+            self.reschedule(name, time() + job.INTERVAL)
+        finally:
+            jobs_running.dec(job=name)
+            job_runs.inc(job=name, status=status)
+            job_duration.observe(time() - current, job=name)
@@ -0,0 +1,248 @@
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Iterator, Optional
+from aiohttp import web
+from ..log import log
+
+DURATION_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    300,
+    900,
+    3600,
+)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+BYTE_BUCKETS = tuple(1 << i for i in range(10, 28, 2))
+
+Sample = tuple[str, dict[str, str], float]
+
+
+class Metric(ABC):
+    TYPE: str
+    name: str
+    help: str
+    labels: tuple[str, ...]
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        registry.register(self)
+
+    def key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def label_dict(self, key: tuple[str, ...]) -> dict[str, str]:
+        return dict(zip(self.labels, key))
+
+    @abstractmethod
+    def samples(self) -> Iterator[Sample]:
+        pass
+
+    def snapshot(self) -> Iterator[Sample]:
+        return self.samples()
+
+
+class Counter(Metric):
+    TYPE = "counter"
+    values: dict[tuple[str, ...], float]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values = defaultdict(float)
+
+    def inc(self, amount: float = 1, **labels):
+        self.values[self.key(labels)] += amount
+
+    def samples(self) -> Iterator[Sample]:
+        for key, value in list(self.values.items()):
+            yield self.name, self.label_dict(key), value
+
+
+class Gauge(Counter):
+    TYPE = "gauge"
+
+    def set(self, value: float, **labels):
+        self.values[self.key(labels)] = value
+
+    def dec(self, amount: float = 1, **labels):
+        self.values[self.key(labels)] -= amount
+
+
+class Histogram(Metric):
+    TYPE = "histogram"
+    buckets: tuple[float, ...]
+    counts: dict[tuple[str, ...], list[int]]
+    sums: dict[tuple[str, ...], float]
+
+    def __init__(self, *args, buckets: tuple[float, ...] = DURATION_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = buckets
+        self.counts = defaultdict(lambda: [0] * (len(self.buckets) + 1))
+        self.sums = defaultdict(float)
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        self.counts[key][bisect_left(self.buckets, value)] += 1
+        self.sums[key] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = perf_counter()
+
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def samples(self) -> Iterator[Sample]:
+        for key, counts in list(self.counts.items()):
+            labels = self.label_dict(key)
+            total = 0
+
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                total += count
+                le = "+Inf" if bound == float("inf") else str(bound)
+                yield f"{self.name}_bucket", {**labels, "le": le}, total
+
+            yield f"{self.name}_sum", labels, self.sums[key]
+            yield f"{self.name}_count", labels, total
+
+    def snapshot(self) -> Iterator[Sample]:
+        # Buckets stay on the Prometheus endpoint, history keeps the totals
+        for key, counts in list(self.counts.items()):
+            labels = self.label_dict(key)
+
+            yield f"{self.name}_sum", labels, self.sums[key]
+            yield f"{self.name}_count", labels, sum(counts)
+
+
+class Registry:
+    metrics: list[Metric]
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric: Metric):
+        self.metrics.append(metric)
+
+    def samples(self) -> Iterator[Sample]:
+        for metric in self.metrics:
+            yield from metric.samples()
+
+    def snapshot(self) -> Iterator[Sample]:
+        for metric in self.metrics:
+            yield from metric.snapshot()
+
+    def render(self) -> str:
+        lines = []
+
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.TYPE}")
+
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{format_labels(labels)} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+
+    escaped = (
+        (k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels.items()
+    )
+
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+async def serve_metrics(host: str, port: int) -> Optional[web.AppRunner]:
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(
+            text=registry.render(), content_type="text/plain", charset="utf-8"
+        )
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+
+    await runner.setup()
+
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as e:
+        log.error(f"Unable to serve metrics on {host}:{port}: {e}")
+        await runner.cleanup()
+        return None
+
+    log.info(f"Serving metrics on http://{host}:{port}/metrics")
+
+    return runner
+
+
+registry = Registry()
+
+job_runs = Counter(
+    "metagnosis_job_runs_total", "Job runs by outcome", ("job", "status")
+)
+job_duration = Histogram(
+    "metagnosis_job_duration_seconds", "Job run duration", ("job",)
+)
+jobs_running = Gauge("metagnosis_jobs_running", "Jobs currently running", ("job",))
+http_requests = Counter(
+    "metagnosis_http_requests_total", "HTTP responses by status", ("method", "status")
+)
+http_latency = Histogram(
+    "metagnosis_http_request_seconds", "Time to first response byte", ("method",)
+)
+downloads = Counter(
+    "metagnosis_pdf_downloads_total", "PDF downloads by outcome", ("origin", "status")
+)
+download_bytes = Counter(
+    "metagnosis_pdf_download_bytes_total", "Bytes of PDFs saved", ("origin",)
+)
+download_size = Histogram(
+    "metagnosis_pdf_download_size_bytes",
+    "Size of saved PDFs",
+    ("origin",),
+    buckets=BYTE_BUCKETS,
+)
+download_latency = Histogram(
+    "metagnosis_pdf_download_seconds", "PDF download duration", ("origin",)
+)
+pages_extracted = Counter("metagnosis_extract_pages_total", "Pages extracted")
+extract_page_seconds = Histogram(
+    "metagnosis_extract_page_seconds", "Extraction time per page of a PDF"
+)
+encode_batch_size = Histogram(
+    "metagnosis_encode_batch_size",
+    "Texts per encoder micro-batch",
+    buckets=SIZE_BUCKETS,
+)
+encode_batch_seconds = Histogram(
+    "metagnosis_encode_batch_seconds", "Encoder micro-batch latency"
+)
+encode_cache = Counter(
+    "metagnosis_encode_cache_total", "Embedding cache lookups", ("result",)
+)
+pdf_queue = Gauge("metagnosis_pdf_unprocessed", "Unprocessed rows in the pdf table")
+publisher_stage = Histogram(
+    "metagnosis_publisher_stage_seconds", "Publisher stage duration", ("stage",)
+)
@@ -0,0 +1,40 @@
+from asyncio import Queue, gather
+from typing import Any, Awaitable, Callable, Optional
+from ..log import log
+
+
+async def run_stage(
+    name: str,
+    work: Callable[[Any], Awaitable[Any]],
+    inbox: Queue,
+    outbox: Optional[Queue],
+    workers: int,
+    failed: Optional[Callable[[Any], None]] = None,
+):
+    # None marks the end of the stream, it is passed on once every worker is done
+    async def worker():
+        while 1:
+            item = await inbox.get()
+
+            if item is None:
+                inbox.put_nowait(None)
+                return
+
+            try:
+                result = await work(item)
+            except Exception as e:
+                log.info(f"Pipeline stage {name} failed")
+                log.exception(e)
+
+                if failed is not None:
+                    failed(item)
+
+                continue
+
+            if outbox is not None and result:
+                await outbox.put(result)
+
+    await gather(*(worker() for _ in range(workers)))
+
+    if outbox is not None:
+        await outbox.put(None)
@@ -0,0 +1,40 @@
+from asyncio import Lock, sleep
+from time import monotonic
+
+
+class TokenBucket:
+    rate: float
+    capacity: float
+    tokens: float
+    updated: float
+    paused_until: float
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        self.paused_until = 0
+        self.lock = Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while 1:
+                now = monotonic()
+
+                if now < self.paused_until:
+                    await sleep(self.paused_until - now)
+                    continue
+
+                elapsed = now - self.updated
+                self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                await sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, monotonic() + seconds)
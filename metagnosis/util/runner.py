@@ -0,0 +1,25 @@
+from asyncio import CancelledError, Task, new_event_loop
+from os import _exit
+from signal import SIGTERM, SIGINT
+from typing import Any, Callable, Coroutine
+
+
+def shutdown(task: Task):
+    # Cancel running jobs on the first signal, give up on the second
+    if task.cancelling():
+        _exit(1)
+
+    task.cancel()
+
+
+def run(main: Callable[[], Coroutine[Any, Any, Any]]):
+    loop = new_event_loop()
+    task = loop.create_task(main())
+
+    for sig in (SIGTERM, SIGINT):
+        loop.add_signal_handler(sig, shutdown, task)
+
+    try:
+        loop.run_until_complete(task)
+    except CancelledError:
+        pass
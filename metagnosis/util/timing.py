@@ -0,0 +1,13 @@
+from contextlib import contextmanager
+from time import perf_counter
+from ..log import log
+
+
+@contextmanager
+def timed(phase: str):
+    start = perf_counter()
+
+    try:
+        yield
+    finally:
+        log.info(f"{phase} took {perf_counter() - start:.2f}s")
@@ -0,0 +1,71 @@
+from asyncio import Lock
+
+from aiosqlite import connect
+
+from .config import get_config
+from .gateway.data_gateway import open_database
+from .gateway.document import DocumentGateway
+from .gateway.embedding_cache import EmbeddingCacheGateway
+from .gateway.encoder import EncoderGateway
+from .gateway.extractor import ExtractionGateway
+from .gateway.http import HTTPGateway
+from .gateway.metrics import MetricsGateway
+from .gateway.pdf import PDFGateway
+from .gateway.text import TextGateway
+from .gateway.write_queue import WriteQueue
+from .job.doc_processor import DocumentProcessorJob
+from .job.metrics import MetricsJob
+from .log import log
+from .util.job_server import JobServer
+from .util.metrics import serve_metrics
+from .util.runner import run
+
+
+async def main():
+    config = get_config()
+    conn = await open_database(config.db_path)
+    job_conn = await connect(config.job_path)
+    process_lock = Lock()
+
+    writer = WriteQueue(conn, process_lock, config.write_window, config.write_batch)
+    http = HTTPGateway()
+    document = await DocumentGateway.new(
+        conn, config.storage_path, process_lock, writer
+    )
+    pdf = await PDFGateway.new(conn, config.storage_path, process_lock, writer, http)
+    text = await TextGateway.new(conn, config.storage_path, process_lock, writer)
+    cache = await EmbeddingCacheGateway.new(
+        conn, config.storage_path, process_lock, writer
+    )
+    metrics = await MetricsGateway.new(conn, config.storage_path, process_lock, writer)
+    encoder = EncoderGateway(cache)
+    extractor = ExtractionGateway(text)
+    job = DocumentProcessorJob(document, pdf, encoder, extractor)
+    server = JobServer(job_conn, [job, MetricsJob(metrics, pdf, job.worker)])
+    metrics_server = None
+
+    log.info(f"Starting document worker {job.worker}")
+
+    if config.metrics_worker_port:
+        start = config.metrics_worker_port
+
+        for port in range(start, start + config.metrics_worker_ports):
+            metrics_server = await serve_metrics(config.metrics_host, port)
+
+            if metrics_server is not None:
+                break
+
+    try:
+        await server.start()
+    finally:
+        if metrics_server is not None:
+            await metrics_server.cleanup()
+
+        await writer.flush()
+        await http.close()
+        extractor.close(wait=False)
+        await encoder.close()
+
+
+if __name__ == "__main__":
+    run(main)